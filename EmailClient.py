@@ -1,7 +1,44 @@
 from msal import ConfidentialClientApplication
-import os, requests, base64, json
+import os, requests, base64, json, time, threading
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from utils.http import new_session, CallStats
+
+load_dotenv()
+
+# * The token and the connection pool are shared by every EmailClient in the process.
+# * Refresh the token a few minutes before it expires so no request goes out with a stale one.
+TOKEN_REFRESH_MARGIN = 300
+GRAPH_TIMEOUT = (5, 60)  # (connect, read) in seconds
+
+#! Graph accepts at most 20 sub-requests in one $batch call.
+BATCH_LIMIT = 20
+BATCH_WORKERS = int(os.getenv("GRAPH_BATCH_WORKERS", 4))
+BATCH_RETRIES = 3
+RETRYABLE_STATUS = (429, 503, 504)
+
+_token_lock = threading.Lock()
+_token = {"access_token": None, "expires_at": 0.0}
+_session = new_session(pool_maxsize=int(os.getenv("GRAPH_POOL_SIZE", 20)))
+_stats = CallStats()
+
+MAX_RETRY_AFTER = 60
+
+
+def retry_after_seconds(value, default: float) -> float:
+    # Retry-After is either a number of seconds or an HTTP date.
+    if value is None:
+        return default
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        try:
+            seconds = (parsedate_to_datetime(str(value)) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return default
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
 
 
 class EmailClient:
@@ -31,17 +68,38 @@ class EmailClient:
         self.resource = f"users/{self.mail}/mailfolders/inbox/messages"
 
         self.EXPIRE_TIME = 1
+        # * The first delta sync (no stored delta link) only looks back this many days.
+        self.DELTA_SYNC_DAYS = int(os.getenv("DELTA_SYNC_DAYS", 7))
 
     def get_token(self):
-        # Define scopes for the resources you want to access
-        scopes = ["https://graph.microsoft.com/.default"]
-        # Acquire a token
-        res = self.app.acquire_token_for_client(scopes=scopes)
-        return res["access_token"]
+        with _token_lock:
+            if time.time() < _token["expires_at"] - TOKEN_REFRESH_MARGIN:
+                return _token["access_token"]
+
+            # Define scopes for the resources you want to access
+            scopes = ["https://graph.microsoft.com/.default"]
+            # Acquire a token
+            with _stats.timer("acquire_token"):
+                res = self.app.acquire_token_for_client(scopes=scopes)
+            _token["access_token"] = res["access_token"]
+            _token["expires_at"] = time.time() + int(res.get("expires_in", 3599))
+            return _token["access_token"]
 
     def headers(self, accept: str = "application/json"):
         return {"Authorization": f"Bearer {self.get_token()}", "Accept": accept}
 
+    def request(self, name: str, method: str, url: str, accept: str = "application/json", **kwargs):
+        # Every Graph call goes through the shared session so the connection is reused, and is timed under "name".
+        if not url.startswith("http"):
+            url = f"{self.microsoft_url}/{url}"
+        kwargs.setdefault("timeout", GRAPH_TIMEOUT)
+        headers = {**self.headers(accept=accept), **kwargs.pop("headers", {})}
+        with _stats.timer(name):
+            return _session.request(method, url, headers=headers, **kwargs)
+
+    def call_stats(self):
+        return _stats.snapshot()
+
     def get_expiry_dt(self):
         #! Note: Maximum expirationDateTime is under 3 days.
         #! From microsoft documentation 4230 Minutes for mail resource. More than this it gives BadRequest.
@@ -62,58 +120,127 @@ class EmailClient:
             "resource": f"users/{self.mail}/mailFolders('inbox')/messages",
             "expirationDateTime": self.get_expiry_dt(),
         }
-        response = requests.post(
-            url=f"{self.microsoft_url}/subscriptions",
-            headers=self.headers(accept="application/json"),
-            json=payload,
+        response = self.request(
+            "create_subscription", "POST", "subscriptions", json=payload
         )
 
         return response.json(), response.status_code
 
     def update_subscription(self, subscriptionId):
         payload = {"expirationDateTime": self.get_expiry_dt()}
-        response = requests.patch(
-            url=f"{self.microsoft_url}/subscriptions/{subscriptionId}",
-            headers=self.headers(accept="application/json"),
-            json=payload,
+        response = self.request(
+            "update_subscription", "PATCH", f"subscriptions/{subscriptionId}", json=payload
         )
 
         return response.json(), response.status_code
 
     def get_all_subs(self):
-        response = requests.get(
-            url=f"{self.microsoft_url}/subscriptions",
-            headers=self.headers(accept="application/json"),
-        )
+        response = self.request("get_all_subs", "GET", "subscriptions")
         return response.json(), response.status_code
 
     def delete_subscription(self, subscriptionId):
-        response = requests.delete(
-            url=f"{self.microsoft_url}/subscriptions/{subscriptionId}",
-            headers=self.headers(accept="application/json"),
+        response = self.request(
+            "delete_subscription", "DELETE", f"subscriptions/{subscriptionId}"
         )
 
         print(response.status_code)
 
     def delete_all_subscription(self, subscriptionIds):
-        for id in subscriptionIds:
-            self.delete_subscription(id)
+        responses = self.batch(
+            [{"method": "DELETE", "url": f"/subscriptions/{id}"} for id in subscriptionIds]
+        )
+        for id, res in zip(subscriptionIds, responses):
+            print(id, res["status"])
+
+    def batch(self, sub_requests: list) -> list:
+        # * Sends sub-requests ({"method", "url", "body", "headers"}) through $batch, 20 per call.
+        # * Batches run concurrently and the responses come back in the same order as sub_requests.
+        # * url is relative to the version root, e.g. "/users/{mail}/messages/{id}".
+        responses = [None] * len(sub_requests)
+        chunks = [
+            list(range(start, min(start + BATCH_LIMIT, len(sub_requests))))
+            for start in range(0, len(sub_requests), BATCH_LIMIT)
+        ]
+        if not chunks:
+            return responses
+
+        with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(chunks))) as executor:
+            list(
+                executor.map(
+                    lambda indexes: self._send_batch(sub_requests, indexes, responses),
+                    chunks,
+                )
+            )
+
+        #! A sub-request Graph left out of its batch response still gets an entry, callers read res["status"].
+        return [
+            res if res is not None else {"id": str(i), "status": 0, "body": "No response for sub-request"}
+            for i, res in enumerate(responses)
+        ]
+
+    def _send_batch(self, sub_requests: list, indexes: list, responses: list):
+        pending = indexes
+        for attempt in range(BATCH_RETRIES + 1):
+            payload = {
+                "requests": [{"id": str(i), **sub_requests[i]} for i in pending]
+            }
+            try:
+                response = self.request("batch", "POST", "$batch", json=payload)
+                items = response.json().get("responses", []) if response.status_code == 200 else []
+            except (requests.RequestException, ValueError) as e:
+                for i in pending:
+                    responses[i] = {"id": str(i), "status": 0, "body": str(e)}
+                return
+
+            if response.status_code != 200:
+                # The whole batch was rejected, retry it as one unit if Graph asks us to.
+                if response.status_code in RETRYABLE_STATUS and attempt < BATCH_RETRIES:
+                    time.sleep(retry_after_seconds(response.headers.get("Retry-After"), 2**attempt))
+                    continue
+                for i in pending:
+                    responses[i] = {"id": str(i), "status": response.status_code, "body": response.text}
+                return
+
+            retry, wait = [], 0
+            for item in items:
+                index = int(item["id"])
+                if item["status"] in RETRYABLE_STATUS and attempt < BATCH_RETRIES:
+                    retry.append(index)
+                    retry_after = (item.get("headers") or {}).get("Retry-After")
+                    wait = max(wait, retry_after_seconds(retry_after, 2**attempt))
+                else:
+                    responses[index] = item
+
+            if not retry:
+                return
+            pending = retry
+            time.sleep(wait)
 
     def get_mail(self, resource):
-        response = requests.get(
-            url=f"{self.microsoft_url}/{resource}",
-            headers=self.headers(accept="application/json"),
-        )
+        response = self.request("get_mail", "GET", resource)
         return response.json(), response.status_code
 
     def get_attachments(self, email_id):
-        response = requests.get(
-            url=f"{self.microsoft_url}/{self.resource}/{email_id}/attachments",
-            headers=self.headers(),
+        response = self.request(
+            "list_attachments", "GET", f"{self.resource}/{email_id}/attachments"
         )
 
         attachments = response.json()["value"]
 
+        # Attachments without inline contentBytes are downloaded together through $batch.
+        # * $batch returns non-JSON bodies ($value) as base64 strings.
+        to_fetch = [a for a in attachments if "contentBytes" not in a]
+        fetched = self.batch(
+            [
+                {
+                    "method": "GET",
+                    "url": f"/{self.resource}/{email_id}/attachments/{a['id']}/$value",
+                }
+                for a in to_fetch
+            ]
+        )
+        values = {a["id"]: res for a, res in zip(to_fetch, fetched)}
+
         attachments_list = []
 
         for attachment in attachments:
@@ -122,39 +249,65 @@ class EmailClient:
             if "contentBytes" in attachment:
                 file_data = base64.b64decode(attachment["contentBytes"])
             else:
-                res = requests.get(
-                    f"{self.microsoft_url}/{self.resource}/{email_id}/attachments/{attachment['id']}/$value",
-                    headers=self.headers(),
+                res = values[attachment["id"]]
+                if res["status"] != 200:
+                    print("Error while downloading attachment:", attachment_name, res)
+                    continue
+                body = res.get("body", "")
+                file_data = (
+                    base64.b64decode(body)
+                    if isinstance(body, str)
+                    else json.dumps(body).encode()
                 )
-                file_data = res.content
 
             attachments_list.append(
                 {
                     "filename": attachment_name,
                     "content_bytes": file_data,
+                    # Used by FileHandler when the leading bytes do not identify the file.
+                    "content_type": attachment.get("contentType"),
                 }
             )
 
         return attachments_list
 
     def change_status(self, email_id: str):
-        response = requests.patch(
-            url=f"{self.microsoft_url}/users/{self.mail}/mailfolders/inbox/messages/{email_id}",
-            headers=self.headers(accept="application/json"),
+        response = self.request(
+            "change_status",
+            "PATCH",
+            f"users/{self.mail}/mailfolders/inbox/messages/{email_id}",
             json={"isRead": True},
         )
 
         return response.json(), response.status_code
 
+    def change_status_many(self, email_ids: list):
+        # Marks queued mails as read through $batch, 20 per call. Returns the status of each id.
+        if not email_ids:
+            return []
+        responses = self.batch(
+            [
+                {
+                    "method": "PATCH",
+                    "url": f"/users/{self.mail}/mailfolders/inbox/messages/{email_id}",
+                    "headers": {"Content-Type": "application/json"},
+                    "body": {"isRead": True},
+                }
+                for email_id in email_ids
+            ]
+        )
+        for email_id, res in zip(email_ids, responses):
+            if res["status"] != 200:
+                print("Error while marking mail as read:", email_id, res["status"])
+        return [res["status"] for res in responses]
+
     def get_mails_manually(self):
         url = f"{self.microsoft_url}/users/{self.mail}/mailfolders/inbox/messages"
         params = {
             "$filter": "isRead eq false",
             "$select": "subject, from, toRecipients, receivedDateTime, body, ccRecipients, bodyPreview, hasAttachments",
         }
-        response = requests.get(
-            url, headers=self.headers(accept="application/json"), params=params
-        )
+        response = self.request("get_mails_manually", "GET", url, params=params)
 
         if response.status_code == 200:
             email_res: dict = response.json()
@@ -165,6 +318,50 @@ class EmailClient:
 
         return []
 
+    def get_mails_delta(self, delta_link: str = None):
+        # * Generator over the pages of a /messages/delta query.
+        # * Yields (emails, delta_link); delta_link is None for every page except the last one.
+        # * Removed messages come back with an "@removed" key and are passed through as they are.
+        url = delta_link
+        if not url:
+            url, params = self._initial_delta_query()
+        else:
+            params = None
+
+        while url:
+            response = self.request(
+                "get_mails_delta",
+                "GET",
+                url,
+                params=params,
+                headers={"Prefer": "odata.maxpagesize=50"},
+            )
+            params = None
+
+            if response.status_code == 410 and delta_link:
+                #! The stored delta link expired, Graph wants a full resync.
+                print("Delta link expired, restarting the sync")
+                delta_link = None
+                url, params = self._initial_delta_query()
+                continue
+
+            if response.status_code != 200:
+                print("Error retrieving delta emails:", response.text)
+                return
+
+            email_res: dict = response.json()
+            url = email_res.get("@odata.nextLink")
+            yield email_res.get("value", []), email_res.get("@odata.deltaLink")
+
+    def _initial_delta_query(self):
+        since = datetime.now(timezone.utc) - timedelta(days=self.DELTA_SYNC_DAYS)
+        url = f"users/{self.mail}/mailfolders/inbox/messages/delta"
+        params = {
+            "$filter": f"receivedDateTime ge {since.strftime('%Y-%m-%dT%H:%M:%SZ')}",
+            "$select": "subject, from, toRecipients, receivedDateTime, body, ccRecipients, bodyPreview, hasAttachments, isRead",
+        }
+        return url, params
+
     # def get_msg(self):
     #     id = "AAMkADc1YTFiNmNhLWFlMWYtNDQzMC1hYjYzLTk1OTk5N2E5NmM2NwBGAAAAAAC5q2EL4CXsQaJsevVNAiHNBwAGM8_OWo5GRK7TJ0YZXSJzAAAAAAEMAAAGM8_OWo5GRK7TJ0YZXSJzAAQUwHSoAAA="
     #     url = f"{self.microsoft_url}/users/{self.mail}/mailfolders/inbox/messages/{id}"
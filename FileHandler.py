@@ -2,109 +2,247 @@ import numpy as np
 import cv2
 import img2pdf
 import patoolib
+from PIL import Image, ImageOps
 
-import os, logging, tempfile, subprocess
+import os, io, logging, tempfile, hashlib, threading, multiprocessing, zipfile
 from email import message_from_bytes, policy
 from email.message import EmailMessage
-from typing import List, Dict
+from typing import List, Dict, Tuple, Iterator
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from utils.helpers import replace_special_characters
-
-from threading import Thread
+from utils.images import is_grayscale
+from utils.variables import Bill_Process_Status
+from utils import filetype
+from services import libreoffice
 
 logging.getLogger("patool").setLevel(logging.WARNING)
 
+# * Files of one email are converted by FILE_THREADS threads, whatever the number of attachments or archive members.
+FILE_THREADS = int(os.getenv("FILE_THREADS", 4))
+# * CPU bound image decoding and img2pdf run in FILE_PROCESSES worker processes. 0 runs them in the calling thread.
+#! Celery prefork workers are daemonic and can not start child processes, there the images are converted in the thread.
+FILE_PROCESSES = int(os.getenv("FILE_PROCESSES", min(4, os.cpu_count() or 1)))
+
+# * Images bigger than IMAGE_MAX_SIDE px or IMAGE_MAX_BYTES (mostly phone photos) are downsized,
+# * optionally turned to grayscale and recompressed before they are wrapped in a PDF.
+IMAGE_NORMALIZE = os.getenv("IMAGE_NORMALIZE", "true").lower() == "true"
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "false").lower() == "true"
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 3000))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 2 * pow(10, 6)))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 80))
+
+# * Limits against zip bombs and endless nesting. Depth counts archives and .eml files inside each other.
+# * Entries and bytes are counted once per email, over all archives including nested ones.
+ARCHIVE_MAX_DEPTH = int(os.getenv("ARCHIVE_MAX_DEPTH", 3))
+ARCHIVE_MAX_ENTRIES = int(os.getenv("ARCHIVE_MAX_ENTRIES", 1000))
+ARCHIVE_MAX_TOTAL_BYTES = int(os.getenv("ARCHIVE_MAX_TOTAL_BYTES", 200 * pow(10, 6)))
+ARCHIVE_MAX_RATIO = int(os.getenv("ARCHIVE_MAX_RATIO", 100))
+
+_process_pool: ProcessPoolExecutor = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None and FILE_PROCESSES > 0:
+            # "spawn" because forking while other threads hold locks can deadlock the child.
+            _process_pool = ProcessPoolExecutor(
+                max_workers=FILE_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+
+def convert_image(buffer: bytes) -> bytes:
+    # Module level so it can run in the process pool. Returns None for small images (logos, signatures).
+    #!Allowed extentions for cv2 imread()
+    # "*.bmp", "*.dib",
+    # "*.jpeg", "*.jpg", "*.jpe",
+    # "*.jp2",
+    # "*.png",
+    # "*.webp",
+    # "*.avif",
+    # "*.pbm", "*.pgm", "*.ppm", "*.pxm", "*.pnm",
+    # "*.pfm",
+    # "*.sr", "*.ras",
+    # "*.tiff", "*.tif",
+    # "*.exr",
+    # "*.hdr", "*.pic"
+    try:
+        width, height = image_size(buffer)
+        if height <= 300 and width <= 300:
+            return None
+    except Exception as e:
+        print("Error in image filter:", e)
+
+    if IMAGE_NORMALIZE:
+        try:
+            buffer = normalize_image(buffer)
+        except Exception as e:
+            print("Error while normalizing image:", e)
+
+    return img2pdf.convert(buffer)
+
+
+def image_size(buffer: bytes):
+    # Pillow only parses the header on open, the pixels are not decoded.
+    try:
+        with Image.open(io.BytesIO(buffer)) as image:
+            return image.size
+    except Exception:
+        # Formats Pillow can not read (exr, hdr, ...) still need a full cv2 decode.
+        nparr = np.frombuffer(buffer, np.uint8)
+        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        height, width = image.shape[:2]
+        return width, height
+
+
+def normalize_image(buffer: bytes) -> bytes:
+    # Returns the buffer unchanged when the image is already small enough.
+    with Image.open(io.BytesIO(buffer)) as image:
+        if max(image.size) <= IMAGE_MAX_SIDE and len(buffer) <= IMAGE_MAX_BYTES:
+            return buffer
+        #! Multi page TIFFs (scanned faxes) would keep only their first page as a JPEG, img2pdf converts every page.
+        if getattr(image, "n_frames", 1) > 1:
+            return buffer
+
+        # draft() lets the JPEG decoder scale down while decoding, which is much cheaper than a full decode.
+        image.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        # Phone photos are often stored sideways with an EXIF rotation.
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        image = image.convert("L") if IMAGE_GRAYSCALE or is_grayscale(image) else image.convert("RGB")
+
+        out = io.BytesIO()
+        image.save(out, format="jpeg", quality=IMAGE_QUALITY)
+        return out.getvalue()
+
 
 class PdfFile:
-    def __init__(self, filename: str, source_filename: str, content_byte: bytes):
+    def __init__(
+        self, filename: str, source_filename: str, content_byte: bytes, content_hash: str, converted: bool = True
+    ):
         self.filename = filename
         self.content_byte = content_byte
         self.source_filename = source_filename
+        # False when content_byte are the source bytes as received (PDF files), see tasks.process_resource_and_files.
+        self.converted = converted
+        # * sha256 of the source file, used to recognise the same file sent again in another email.
+        #! Not of content_byte: img2pdf, LibreOffice and wkhtmltopdf write timestamps and ids into every PDF.
+        self.content_hash = content_hash
+
+
+class FileContext:
+    # Everything one conversion needs, so concurrent files never share state.
+    # order is the position of the file in the email, e.g. (2,) for the 3rd attachment and (2, 0) for the first file inside it.
+    # kind and ext come from utils.filetype.sniff, status is set when the file can not be processed.
+    # content_hash is the sha256 of the source bytes, the PDF made from them keeps it.
+    def __init__(
+        self,
+        filename: str,
+        content_bytes: bytes,
+        order: Tuple[int, ...],
+        unique_name: str,
+        kind: str = None,
+        ext: str = "",
+        content_hash: str = None,
+    ):
+        self.filename = filename
+        self.content_bytes = content_bytes
+        self.order = order
+        self.unique_name = unique_name
+        self.kind = kind
+        self.ext = ext
+        self.content_hash = content_hash or hashlib.sha256(content_bytes).hexdigest()
+        self.status: Bill_Process_Status = None
 
 
 class FileHandler:
     def __init__(self, receivedDateTime: datetime):
         self.timestamp = receivedDateTime.strftime("%Y%m%d%H%M%S")
         self.pdf_files: List[PdfFile] = []
-        self.unique_name: str = None
-        self.source_filename: str = None
-        self.libreoffice_path = r"C:\\Program Files\\LibreOffice\\program\\soffice.exe"
-        pass
-
-    def image_to_pdf(self, buffer: bytes):
-        #!Allowed extentions for cv2 imread()
-        # "*.bmp", "*.dib",
-        # "*.jpeg", "*.jpg", "*.jpe",
-        # "*.jp2",
-        # "*.png",
-        # "*.webp",
-        # "*.avif",
-        # "*.pbm", "*.pgm", "*.ppm", "*.pxm", "*.pnm",
-        # "*.pfm",
-        # "*.sr", "*.ras",
-        # "*.tiff", "*.tif",
-        # "*.exr",
-        # "*.hdr", "*.pic"
-        valid_image: bytes = None
+        # Files that could not be identified, as {"filename", "status"}.
+        self.invalid_files: List[Dict] = []
+        # Archive budget shared by all archives of the email, archives are read on several threads.
+        self.archive_lock = threading.Lock()
+        self.archive_entries = 0
+        self.archive_bytes = 0
+
+    def reserve_archive_budget(self, size: int) -> bool:
+        # Charges one archive member of size bytes, False once the email is over ARCHIVE_MAX_ENTRIES or ARCHIVE_MAX_TOTAL_BYTES.
+        with self.archive_lock:
+            if self.archive_entries >= ARCHIVE_MAX_ENTRIES or self.archive_bytes + size > ARCHIVE_MAX_TOTAL_BYTES:
+                return False
+            self.archive_entries += 1
+            self.archive_bytes += size
+            return True
+
+    def make_context(self, file: Dict[str, bytes], order: Tuple[int, ...]) -> FileContext:
+        filename = file["filename"] or ""
+        name, _ = os.path.splitext(filename)
+        modified_name = replace_special_characters(name)
+        # Top level files keep the old "-1" suffix, nested files get "-1-2" so names never collide.
+        position = "-".join(str(index + 1) for index in order)
+        unique_name = f"{self.timestamp}-{modified_name}-{position}.pdf"
+        content_bytes = file["content_bytes"] or b""
+        kind, ext = filetype.sniff(content_bytes, filename, file.get("content_type"))
+        # Rendered email bodies come with the hash of their html, see tasks.process_email.
+        return FileContext(filename, content_bytes, order, unique_name, kind, ext, file.get("content_hash"))
+
+    def image_to_pdf(self, ctx: FileContext) -> List[PdfFile]:
         try:
-            nparr = np.frombuffer(buffer, np.uint8)
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            height, width = image.shape[:2]
-            if height > 300 or width > 300:
-                valid_image = buffer
+            pool = get_process_pool()
+            if pool:
+                try:
+                    content = pool.submit(convert_image, ctx.content_bytes).result()
+                except (AssertionError, OSError, RuntimeError) as e:
+                    # The pool can not be used in this worker (daemonic or broken), fall back to the thread.
+                    print("Process pool unavailable, converting in thread:", e)
+                    content = convert_image(ctx.content_bytes)
+            else:
+                content = convert_image(ctx.content_bytes)
         except Exception as e:
-            valid_image = buffer
-            print(self.unique_name)
-            print("Error in image filter cv2:", e)
+            print(ctx.unique_name)
+            print("Error while converting image to pdf:", e)
+            return []
 
-        if valid_image:
-            try:
-                self.pdf_files.append(
-                    PdfFile(
-                        self.unique_name,
-                        self.source_filename,
-                        img2pdf.convert(valid_image),
-                    )
-                )
-            except Exception as e:
-                print(self.unique_name)
-                print("Error while converting image to pdf:", e)
+        if content:
+            return [PdfFile(ctx.unique_name, ctx.filename, content, ctx.content_hash)]
+        return []
 
-    def doc_to_pdf(self, buffer: bytes, name: str, ext: str):
-        #! Note It delete the files after some period.
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_file_path = os.path.join(temp_dir, f"{name}{ext}")
+    def doc_to_pdf(self, ctx: FileContext, name: str, ext: str) -> List[PdfFile]:
+        # LibreOffice instances are pooled in services/libreoffice.py.
+        content = libreoffice.convert(ctx.content_bytes, name, ext)
+        if content:
+            return [PdfFile(ctx.unique_name, ctx.filename, content, ctx.content_hash)]
+        return []
 
-            with open(temp_file_path, "wb") as temp_file:
-                temp_file.write(buffer)
+    def docs_to_pdf(self, contexts: List[FileContext]):
+        # Office documents of one email are converted as one batch.
+        files = []
+        for ctx in contexts:
+            name, _ = os.path.splitext(ctx.filename)
+            files.append((ctx.content_bytes, name, ctx.ext))
 
-            try:
-                command = [
-                    self.libreoffice_path,
-                    "--headless",
-                    "--convert-to",
-                    "pdf",
-                    "--outdir",
-                    temp_dir,
-                    temp_file_path,
-                ]
-                subprocess.run(command, check=True)
-            except subprocess.CalledProcessError as e:
-                print(f"Conversion failed: {e}")
-
-            temp_out_path = os.path.join(temp_dir, f"{name}.pdf")
-            if os.path.exists(temp_out_path):
-                with open(temp_out_path, "rb") as f:
-                    self.pdf_files.append(
-                        PdfFile(self.unique_name, self.source_filename, f.read())
-                    )
-
-    def handleEmlFile(self, buffer: bytes):
+        try:
+            contents = libreoffice.convert_many(files)
+        except Exception as e:
+            print("Error while converting office files", e)
+            contents = [None] * len(files)
+
+        results = []
+        for ctx, content in zip(contexts, contents):
+            pdf_files = [PdfFile(ctx.unique_name, ctx.filename, content, ctx.content_hash)] if content else []
+            results.append((ctx, pdf_files, []))
+        return results
+
+    def handleEmlFile(self, ctx: FileContext) -> List[Dict[str, bytes]]:
         files = []
 
         try:
             email_message: EmailMessage = message_from_bytes(
-                buffer, policy=policy.default
+                ctx.content_bytes, policy=policy.default
             )
             attachments = [
                 item
@@ -117,75 +255,149 @@ class FileHandler:
                     {
                         "filename": attachment.get_filename(),
                         "content_bytes": attachment.get_payload(decode=True),
+                        "content_type": attachment.get_content_type(),
                     }
                 )
         except Exception as error:
             print("Error while getting handling .Eml file", error)
 
-        self.collectPdfFiles(files)
+        return files
+
+    def extractZip(self, ctx: FileContext) -> Iterator[Dict[str, bytes]]:
+        # * Reads members straight from the in-memory buffer and yields them one by one,
+        # * so collectPdfFiles can start converting the first members while the rest are still being read.
+        try:
+            with zipfile.ZipFile(io.BytesIO(ctx.content_bytes)) as archive:
+                members = [i for i in archive.infolist() if not i.is_dir() and not i.filename.startswith("__MACOSX/")]
+
+                for info in members:
+                    if info.compress_size and info.file_size / info.compress_size > ARCHIVE_MAX_RATIO:
+                        print(f"{ctx.filename}: skipping {info.filename}, compression ratio is too high")
+                        continue
+                    #! Charged on the size from the header before reading, the read below never returns more.
+                    if not self.reserve_archive_budget(info.file_size):
+                        print(f"{ctx.filename}: archive limits of the email reached, remaining files are skipped")
+                        break
+
+                    try:
+                        with archive.open(info) as member:
+                            #! file_size comes from the header and can lie, so never read more than it claims.
+                            data = member.read(info.file_size + 1)
+                    except Exception as e:
+                        # Encrypted members, corrupt data (zlib.error, EOFError, bad CRC) or unsupported compression.
+                        print(f"{ctx.filename}: can not read {info.filename}", e)
+                        continue
+                    if len(data) > info.file_size:
+                        print(f"{ctx.filename}: skipping {info.filename}, size does not match its header")
+                        continue
 
-    def extractArchive(self, buffer: bytes, filename: str):
+                    yield {"filename": os.path.basename(info.filename), "content_bytes": data}
+        except (zipfile.BadZipFile, OSError, ValueError) as e:
+            print(f"BadZipFile: {ctx.filename}", e)
+
+    def extractArchive(self, ctx: FileContext) -> List[Dict[str, bytes]]:
+        # Only rar and 7z go through patool, zip files are read in memory by extractZip.
         #! Note: To use patool, we have to install 7-zip in the system and set the path of 7-zip in environment variables.
         #! Note It delete the files after some period.
         with tempfile.TemporaryDirectory() as temp_dir:
-            temp_file_path = os.path.join(temp_dir, filename)
+            # Named with the sniffed extension so patool picks the right program for misnamed archives.
+            name, _ = os.path.splitext(os.path.basename(ctx.filename))
+            temp_file_path = os.path.join(temp_dir, f"{name}{ctx.ext}")
             with open(temp_file_path, "wb") as temp_file:
-                temp_file.write(buffer)
+                temp_file.write(ctx.content_bytes)
 
             try:
                 temp_out_path = os.path.join(temp_dir, "archived files")
                 patoolib.extract_archive(archive=temp_file_path, outdir=temp_out_path)
-                extracted_files = [
-                    {
-                        "filename": file,
-                        "content_bytes": open(os.path.join(root, file), "rb").read(),
-                    }
-                    for root, _, files in os.walk(temp_out_path)
-                    for file in files
-                ]
+                extracted_files = []
+                for root, _, files in os.walk(temp_out_path):
+                    for file in files:
+                        path = os.path.join(root, file)
+                        if not self.reserve_archive_budget(os.path.getsize(path)):
+                            print(f"{ctx.filename}: archive limits of the email reached, remaining files are skipped")
+                            return extracted_files
+                        with open(path, "rb") as f:
+                            extracted_files.append({"filename": file, "content_bytes": f.read()})
 
-                self.collectPdfFiles(extracted_files)
+                return extracted_files
             except patoolib.util.PatoolError as e:
                 print(f"PatoolError: {e}")
+        return []
 
     def collectPdfFiles(self, filelist: List[Dict[str, bytes]]) -> List[PdfFile]:
         # Todo: Track failed fails in the DB
-        # We are using threads to concurrently process each file instead of processing them sequentially.
-        threads: List[Thread] = []
-        for index, file in enumerate(filelist):
-            thread = Thread(target=self.process_file, args=(file, index))
-            threads.append(thread)
-            thread.start()
+        # * Files are converted on a bounded thread pool. Files found inside .eml and archives are queued on the same pool,
+        # * and the result is sorted by each file's position in the email, so the order does not depend on timing.
+        results: Dict[Tuple[int, ...], List[PdfFile]] = {}
+        invalid: Dict[Tuple[int, ...], FileContext] = {}
+
+        contexts = [self.make_context(file, (index,)) for index, file in enumerate(filelist)]
+        office = [c for c in contexts if c.kind == filetype.OFFICE]
 
-        for thread in threads:
-            thread.join()
+        with ThreadPoolExecutor(max_workers=FILE_THREADS) as executor:
+            pending = {executor.submit(self.process_file, c) for c in contexts if c not in office}
+            if office:
+                pending.add(executor.submit(self.docs_to_pdf, office))
 
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    for ctx, pdf_files, children in result if isinstance(result, list) else [result]:
+                        results[ctx.order] = pdf_files
+                        if ctx.status is not None:
+                            invalid[ctx.order] = ctx
+                        # Children may be a generator reading the archive, a broken archive only loses its own files.
+                        # What the queued children hold is bounded by the archive budget of the email.
+                        try:
+                            for index, child in enumerate(children):
+                                child_ctx = self.make_context(child, ctx.order + (index,))
+                                pending.add(executor.submit(self.process_file, child_ctx))
+                        except Exception as e:
+                            print("Error while reading files of", ctx.filename, e)
+
+        self.pdf_files = [p for order in sorted(results) for p in results[order]]
+        self.invalid_files = [
+            {"filename": invalid[order].filename, "status": invalid[order].status}
+            for order in sorted(invalid)
+        ]
         return self.pdf_files
 
-    def process_file(self, file, index):
-        filename = file["filename"]
-        filedata = file["content_bytes"]
-        name, ext = os.path.splitext(filename)
+    def process_file(self, ctx: FileContext):
+        # Returns (ctx, pdf files, nested files) for one file. Nested files may be a generator (zip members).
+        # * Routing uses the sniffed kind, not the extension, see utils/filetype.py.
+        name, _ = os.path.splitext(ctx.filename)
 
-        print("Processing..", filename)
+        print("Processing..", ctx.filename, ctx.kind)
 
-        self.source_filename = filename
-        modified_name = replace_special_characters(name)
-        self.unique_name = f"{self.timestamp}-{modified_name}-{index+1}.pdf"
+        containers = [filetype.EML, filetype.ZIP, filetype.RAR, filetype.SEVEN_ZIP]
 
-        if ext == ".pdf":
-            self.pdf_files.append(
-                PdfFile(self.unique_name, self.source_filename, filedata)
-            )
+        try:
+            if ctx.kind == filetype.PDF:
+                return ctx, [PdfFile(ctx.unique_name, ctx.filename, ctx.content_bytes, ctx.content_hash, converted=False)], []
+
+            elif ctx.kind in containers and len(ctx.order) > ARCHIVE_MAX_DEPTH:
+                print(f"{ctx.filename}: nested deeper than {ARCHIVE_MAX_DEPTH} levels, skipped")
+
+            elif ctx.kind == filetype.EML:
+                return ctx, [], self.handleEmlFile(ctx)
 
-        elif ext == "":  # Mostly .eml files
-            self.handleEmlFile(filedata)
+            elif ctx.kind == filetype.ZIP:
+                return ctx, [], self.extractZip(ctx)
 
-        elif ext in [".zip", ".rar"]:
-            self.extractArchive(filedata, filename)
+            elif ctx.kind in [filetype.RAR, filetype.SEVEN_ZIP]:
+                return ctx, [], self.extractArchive(ctx)
 
-        elif ext in [".doc", ".docx", ".xls", ".xlsx", ".csv", ".txt"]:
-            self.doc_to_pdf(filedata, name, ext)
+            elif ctx.kind == filetype.OFFICE:
+                return ctx, self.doc_to_pdf(ctx, name, ctx.ext), []
+
+            elif ctx.kind == filetype.IMAGE:
+                return ctx, self.image_to_pdf(ctx), []
+
+            else:
+                print(f"{ctx.filename}: unrecognized file type")
+                ctx.status = Bill_Process_Status.INVALID_FILE
+        except Exception as e:
+            print("Error while processing", ctx.filename, e)
 
-        elif ext in [".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".tif"]:
-            self.image_to_pdf(filedata)
+        return ctx, [], []
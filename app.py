@@ -5,23 +5,29 @@ from typing import Any, Dict, List
 from datetime import datetime
 import json
 
-from tasks import process_email, process_resource_and_files
-from services.mongodb import client
+from tasks import (
+    process_email,
+    process_notification,
+    process_resource_and_files,
+    sync_mailbox,
+)
+from services.mongodb import client, ensure_indexes
+from utils.idempotency import IdempotencyStore
 from utils.variables import domaine
 
 app = FastAPI()
 email_client = EmailClient()
 db = client["email_client"]
+notification_store = IdempotencyStore()
+
+
+@app.on_event("startup")
+def startup():
+    ensure_indexes()
 
 
 # This class wraps methods for handling background tasks in FastAPI.
 class Bg_Tasks:
-    @staticmethod
-    def resource(resource):
-        response, status = email_client.get_mail(resource)
-        if status == 200:
-            process_email(email=response)
-
     @staticmethod
     def subscription_renewal(subscriptionId):
         response, status = email_client.update_subscription(subscriptionId)
@@ -62,8 +68,9 @@ def delete_all_subscription():
 
 
 """ To ensure that Microsoft receives a 200 status code within 10 seconds, 
-    we've implemented a solution using FastAPI background tasks. 
-    Initially, we promptly return the 200 status code and then proceed with the necessary task asynchronously.
+    the endpoint does no Graph or file work itself. 
+    Microsoft may send several change notifications in one POST, so every entry of data["value"] is read,
+    already seen message ids are dropped and each new message is handed to the Celery queue.
     This approach prevents the occurrence of duplicate emails 
     caused by Microsoft repeatedly calling the endpoint until it receives the expected response within the specified time frame (10 sec). """
 
@@ -81,8 +88,18 @@ def handle_notification(
         )
     else:
         # The resource is nothing but a endpoint 'resource':"users/info@sendhours.com/mailFolders('inbox')/messages"
-        resource = data["value"][0]["resource"]
-        background_tasks.add_task(Bg_Tasks.resource, resource)
+        resources = {}
+        for notification in data.get("value", []):
+            message_id = notification.get("resourceData", {}).get("id")
+            resources[message_id or notification["resource"]] = notification["resource"]
+
+        for key in notification_store.claim_many(list(resources)):
+            try:
+                process_notification.delay(resources[key], key)
+            except Exception as e:
+                # Not queued, so the claim must not keep the catch-up sync from picking the mail up.
+                print("Error while queueing notification:", resources[key], e)
+                notification_store.release([key])
     return JSONResponse(content="", status_code=200, media_type="text/plain")
 
 
@@ -103,18 +120,36 @@ def handle_lifecycleNotification(
     return JSONResponse(content="", status_code=200, media_type="text/plain")
 
 
+# *-- Per-call latency of the Graph requests made by the API process (subscriptions, /emails).
+# *-- The workers log theirs after every process_email and sync_mailbox run.
+@app.get("/stats/graph")
+def graph_stats():
+    return JSONResponse(content=email_client.call_stats(), status_code=200)
+
+
 # *-- This endpoint is used for testing or manually adding an email to the queue if the Microsoft webhook method fails.
 @app.get("/emails")
 def get_emails():
     emails: list = email_client.get_mails_manually()
     received_mails = []
+    queued_ids = []
     for email in emails:
         received_mails.append({"mail": email["from"]["emailAddress"]["address"]})
         process_email.delay(email=email)
+        queued_ids.append(email["id"])
 
+    # Queued mails are marked as read with one $batch call per 20 ids.
+    email_client.change_status_many(queued_ids)
     return received_mails
 
 
+# *-- Queues an incremental sync, only mails received since the last sync are processed.
+@app.get("/emails/delta")
+def sync_emails():
+    task = sync_mailbox.delay()
+    return JSONResponse(content={"task_id": task.id}, status_code=202)
+
+
 # Todo: we need to test this endpoint. Currently, it hasn't been tested.
 @app.post("/upload/")
 def upload(
@@ -0,0 +1,10 @@
+import os
+
+# * Benchmarks run from the repository root: python -m benchmarks.<name> --help
+# * The services read their settings on import, so harmless defaults are set for everything they need.
+os.environ.setdefault("mail", "bills@example.com")
+os.environ.setdefault("boto3_region_name", "us-east-1")
+os.environ.setdefault("boto3_aws_access_key_id", "testing")
+os.environ.setdefault("boto3_aws_secret_access_key", "testing")
+os.environ.setdefault("S3_BUCKET_NAME", "benchmark")
+os.environ.setdefault("data_path", "bill_benchmark")
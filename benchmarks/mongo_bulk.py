@@ -0,0 +1,121 @@
+import argparse, os, random, statistics, time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import MongoClient, DESCENDING
+
+from services.mongodb import INDEXES
+
+# * Insert throughput of one insert_one per file row (the old insert_file loop) against insert_many(ordered=False)
+# * batches (insert_files), and lookup latency on the hot file_table queries without and with the INDEXES set.
+# * Works on its own database, which is dropped first. Needs a running mongod.
+#   python -m benchmarks.mongo_bulk --uri mongodb://localhost:27017 --docs 1000000
+
+
+def file_row(rng: random.Random, index: int, start: datetime) -> dict:
+    # Two files per email on average.
+    content_hash = "%064x" % rng.getrandbits(256)
+    client = f"client{rng.randrange(50)}"
+    corp = f"corp{rng.randrange(20)}"
+    return {
+        "from": f"billing{rng.randrange(5000)}@vendor.com",
+        "to": f"{client}.{corp}@example.com",
+        "timestamp": start + timedelta(minutes=index),
+        "client": client,
+        "property": corp,
+        "type": "mail",
+        "email_table_id": ObjectId("%024x" % (index // 2)),
+        "source_filename": f"invoice-{index}.pdf",
+        "s3_key": f"data/bills/{client}/{corp}/{content_hash}.pdf",
+        "content_hash": content_hash,
+        "ocr_pages": rng.randint(1, 6),
+    }
+
+
+def percentiles(samples: list) -> str:
+    samples = sorted(samples)
+    p50 = statistics.median(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    return f"p50 {p50:8.2f} ms   p95 {p95:8.2f} ms"
+
+
+def query_latency(collection, probes: list, queries: int) -> dict:
+    results = {}
+    lookups = {
+        "email_table_id": lambda row: collection.find_one({"email_table_id": row["email_table_id"]}, {"_id": 1}),
+        "s3_key": lambda row: collection.find_one({"s3_key": row["s3_key"]}, {"_id": 1}),
+        "content_hash": lambda row: collection.find_one({"content_hash": row["content_hash"]}, {"_id": 1}),
+        "client/property listing": lambda row: list(
+            collection.find({"client": row["client"], "property": row["property"]}, {"_id": 1, "source_filename": 1})
+            .sort("timestamp", DESCENDING)
+            .limit(50)
+        ),
+    }
+    for name, lookup in lookups.items():
+        samples = []
+        for row in probes[:queries]:
+            start = time.perf_counter()
+            lookup(row)
+            samples.append((time.perf_counter() - start) * 1000)
+        results[name] = samples
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mongo bulk write and index benchmark")
+    parser.add_argument("--uri", default=os.getenv("db_uri") or "mongodb://localhost:27017")
+    parser.add_argument("--database", default="bill_benchmark")
+    parser.add_argument("--docs", type=int, default=1000000)
+    parser.add_argument("--single-docs", type=int, default=20000, help="rows written one by one")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=50, help="lookups per query, collection scans are slow")
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    client.drop_database(args.database)
+    collection = client[args.database]["file_table"]
+
+    rng = random.Random(42)
+    start = datetime(2023, 1, 1)
+    # Rows are generated batch by batch so a million of them never sit in memory, only the probed ones are kept.
+    probe_indexes = set(rng.sample(range(args.docs), min(args.docs, args.queries)))
+    probes = []
+
+    def batch(first: int, last: int) -> list:
+        rows = [file_row(rng, index, start) for index in range(first, min(last, args.docs))]
+        probes.extend(row.copy() for index, row in enumerate(rows, first) if index in probe_indexes)
+        return rows
+
+    single = batch(0, args.single_docs)
+    begin = time.perf_counter()
+    for row in single:
+        collection.insert_one(row)
+    elapsed = time.perf_counter() - begin
+    print(f"insert_one           {len(single):>9} docs {len(single) / elapsed:>10.0f} docs/s")
+
+    inserted, insert_time = 0, 0.0
+    for first in range(len(single), args.docs, args.batch):
+        rows = batch(first, first + args.batch)
+        begin = time.perf_counter()
+        collection.insert_many(rows, ordered=False)
+        insert_time += time.perf_counter() - begin
+        inserted += len(rows)
+    print(f"insert_many({args.batch})    {inserted:>9} docs {inserted / max(insert_time, 1e-9):>10.0f} docs/s")
+
+    print(f"\n{collection.estimated_document_count()} documents, {len(probes)} lookups per query")
+    without = query_latency(collection, probes, args.queries)
+
+    begin = time.perf_counter()
+    collection.create_indexes(INDEXES["file_table"])
+    print(f"index build {time.perf_counter() - begin:.1f} s")
+    indexed = query_latency(collection, probes, args.queries)
+
+    for name in without:
+        print(f"{name:<24} no index  {percentiles(without[name])}")
+        print(f"{'':<24} indexed   {percentiles(indexed[name])}")
+
+    client.drop_database(args.database)
+
+
+if __name__ == "__main__":
+    main()
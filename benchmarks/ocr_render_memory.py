@@ -0,0 +1,103 @@
+import argparse, io, json, os, resource, shutil, subprocess, sys, tempfile, time
+
+import img2pdf
+import numpy as np
+from PIL import Image, ImageDraw
+
+# * Peak memory of rendering a long scanned PDF for OCR: the old convert_from_bytes (every page in memory)
+# * against aws.iter_pdf_pages (OCR_RENDER_WINDOW pages at a time). Each mode runs in its own process,
+# * so ru_maxrss is the peak of that mode only. Needs poppler (pdftoppm, pdfinfo) like the worker.
+#   python -m benchmarks.ocr_render_memory --pages 200
+
+
+def scanned_page(seed: int, width: int, height: int) -> bytes:
+    # A grayscale "scan": light noise and lines of dark blocks standing in for text.
+    rng = np.random.default_rng(seed)
+    pixels = rng.normal(235, 4, (height, width)).clip(0, 255).astype(np.uint8)
+    image = Image.fromarray(pixels, "L")
+    draw = ImageDraw.Draw(image)
+    for top in range(150, height - 150, 60):
+        left = 120
+        while left < width - 200:
+            word = int(rng.integers(40, 180))
+            draw.rectangle((left, top, left + word, top + 28), fill=int(rng.integers(10, 60)))
+            left += word + 25
+    buffer = io.BytesIO()
+    image.save(buffer, format="jpeg", quality=60)
+    return buffer.getvalue()
+
+
+def make_pdf(path: str, pages: int, width: int, height: int):
+    # A few distinct pages repeated, generating 200 unique pages is slow and does not change the rendering cost.
+    distinct = [scanned_page(seed, width, height) for seed in range(min(pages, 5))]
+    with open(path, "wb") as f:
+        f.write(img2pdf.convert([distinct[i % len(distinct)] for i in range(pages)]))
+
+
+def run_mode(mode: str, pdf_path: str, dpi: int, window: int) -> dict:
+    from pdf2image import convert_from_bytes, pdfinfo_from_path
+    from services import aws
+    from utils.images import encode_for_textract
+
+    start = time.perf_counter()
+    payload_bytes = 0
+    if mode == "all_pages":
+        # Behaviour before the streaming renderer.
+        with open(pdf_path, "rb") as f:
+            images = convert_from_bytes(f.read(), dpi=dpi)
+        for image in images:
+            payload_bytes += len(encode_for_textract(image))
+        pages = len(images)
+    else:
+        page_count = pdfinfo_from_path(pdf_path)["Pages"]
+        pages = 0
+        for _, image in aws.iter_pdf_pages(pdf_path, list(range(1, page_count + 1)), dpi=dpi, window=window):
+            payload_bytes += len(encode_for_textract(image))
+            pages += 1
+
+    return {
+        "mode": mode if mode == "all_pages" else f"window={window}",
+        "pages": pages,
+        "seconds": round(time.perf_counter() - start, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "payload_mb": round(payload_bytes / pow(10, 6), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory of OCR page rendering")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--windows", default="1,2,4", help="comma separated OCR_RENDER_WINDOW values")
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    parser.add_argument("--pdf", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        window = 0 if args.mode == "all_pages" else int(args.mode)
+        print(json.dumps(run_mode(args.mode, args.pdf, args.dpi, window)))
+        return
+
+    if not shutil.which("pdftoppm"):
+        sys.exit("poppler (pdftoppm, pdfinfo) is not installed")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pdf_path = os.path.join(temp_dir, "synthetic.pdf")
+        # US letter at 200 DPI.
+        make_pdf(pdf_path, args.pages, 1700, 2200)
+        print(f"{args.pages} pages, {os.path.getsize(pdf_path) / pow(10, 6):.1f} MB pdf, {args.dpi} DPI")
+
+        print(f"{'mode':<12}{'pages':>7}{'seconds':>10}{'peak RSS MB':>14}{'payload MB':>13}")
+        for mode in ["all_pages"] + args.windows.split(","):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.ocr_render_memory", "--mode", mode,
+                 "--pdf", pdf_path, "--dpi", str(args.dpi)],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{result['mode']:<12}{result['pages']:>7}{result['seconds']:>10}"
+                  f"{result['peak_rss_mb']:>14}{result['payload_mb']:>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse, os, random, time
+from datetime import datetime
+
+from kombu.serialization import dumps, loads
+
+from utils.serializer import SERIALIZER_NAME
+
+# * Encode/decode time and message size of the msgpack-zstd task serializer (utils/serializer.py)
+# * against Celery's default json, on the documents process_resource_and_files receives.
+#   python -m benchmarks.task_serializer --repeat 200
+
+WORDS = "invoice amount due account statement please find attached regards the for of and".split()
+
+
+def html_body(size: int) -> str:
+    # Outlook style HTML: markup, inline styles and text.
+    rng = random.Random(size)
+    parts, length = ["<html><head><style>p{margin:0;font-family:Calibri}</style></head><body>"], 0
+    while length < size:
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 30)))
+        part = f'<p style="font-size:11pt;color:#1f497d"><span>{text}</span></p>\n'
+        parts.append(part)
+        length += len(part)
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def document(body_kb: int, attachments: list, inline: bool) -> dict:
+    # inline=False is the claim check shape (blob references), inline=True the shape with the bytes in the message.
+    files = []
+    for index, size in enumerate(attachments):
+        entry = {"filename": f"invoice-{index}.pdf", "content_type": "application/pdf"}
+        if inline:
+            # PDFs are mostly compressed streams, random bytes are a fair stand-in.
+            entry["content_bytes"] = b"%PDF-1.7\n" + os.urandom(size)
+        else:
+            entry["blob_ref"] = "s3:blobs/" + os.urandom(32).hex()
+        files.append(entry)
+    return {
+        "receivedDateTime": datetime(2024, 5, 2, 9, 30),
+        "attachments": files,
+        "_from": "billing@vendor.com",
+        "to_mail": "client.corp@example.com",
+        "client": "client",
+        "corp": "corp",
+        "type": "mail",
+        "body": html_body(body_kb * 1024),
+        "microsoft_id": "AAMkAD" + os.urandom(60).hex(),
+    }
+
+
+def measure(doc: dict, serializer: str, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        content_type, encoding, data = dumps(doc, serializer=serializer)
+    encode = (time.perf_counter() - start) / repeat * 1000
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        loads(data, content_type, encoding)
+    decode = (time.perf_counter() - start) / repeat * 1000
+    size = len(data.encode() if isinstance(data, str) else data)
+    return encode, decode, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Celery task serializer benchmark")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    cases = {
+        "small body, refs": document(4, [200 * 1024], inline=False),
+        "large body, refs": document(150, [200 * 1024] * 3, inline=False),
+        "small body, inline 2x200KB": document(4, [200 * 1024] * 2, inline=True),
+        "large body, inline 2MB": document(150, [2 * 1024 * 1024], inline=True),
+    }
+
+    print(f"{'document':<28}{'serializer':<14}{'encode ms':>10}{'decode ms':>10}{'bytes':>11}")
+    for name, doc in cases.items():
+        for serializer in ("json", SERIALIZER_NAME):
+            encode, decode, size = measure(doc, serializer, args.repeat)
+            print(f"{name:<28}{serializer:<14}{encode:>10.3f}{decode:>10.3f}{size:>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import argparse, io, time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from utils.images import encode_for_textract, TEXTRACT_MAX_BYTES
+
+# * Encode time, payload bytes and a Textract stub latency for the page encoder, against the behaviour before
+# * utils.images.encode_for_textract (q90 4:4:4 JPEG, encoded again at q50 when it reached 10 MB).
+#   python -m benchmarks.textract_encoding --repeat 3
+
+
+def old_encode_page(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="jpeg", subsampling=0, quality=90)
+    img_data = buffer.getvalue()
+    if len(img_data) / pow(10, 6) >= 10:
+        buffer = io.BytesIO()
+        image.save(buffer, format="jpeg", subsampling=0, quality=50)
+        img_data = buffer.getvalue()
+    return img_data
+
+
+def text_lines(image: Image.Image, rng, ink):
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+    for top in range(height // 15, height - height // 15, max(20, height // 70)):
+        left = width // 14
+        while left < width - width // 10:
+            word = int(rng.integers(width // 50, width // 12))
+            draw.rectangle((left, top, left + word, top + max(8, height // 160)), fill=ink)
+            left += word + width // 70
+    return image
+
+
+def pages() -> dict:
+    # The pages pdf2image hands to the OCR step: RGB images at the render DPI.
+    rng = np.random.default_rng(7)
+    scan = rng.normal(232, 10, (2200, 1700)).clip(0, 255).astype(np.uint8)
+    colour = rng.integers(0, 255, (3300, 2550, 3), dtype=np.uint8)
+    colour[:, :, 1] = colour[:, :, 0] // 2
+    huge = rng.integers(0, 255, (4400, 3400, 3), dtype=np.uint8)
+    return {
+        "scan 200dpi (gray)": text_lines(Image.fromarray(scan).convert("RGB"), rng, (20, 20, 20)),
+        "colour 300dpi": text_lines(Image.fromarray(colour), rng, (0, 0, 90)),
+        "noisy 400dpi (>10MB)": Image.fromarray(huge),
+    }
+
+
+def stub_latency(payload: int, base_ms: float, mbit: float) -> float:
+    # Textract stub: a fixed service time plus the upload of the payload.
+    return base_ms + payload * 8 / (mbit * pow(10, 6)) * 1000
+
+
+def measure(encoder, image: Image.Image, repeat: int):
+    best, data = None, b""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = encoder(image)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Textract page encoding benchmark")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stub-base-ms", type=float, default=250)
+    parser.add_argument("--stub-mbit", type=float, default=100, help="upload bandwidth of the stub")
+    args = parser.parse_args()
+
+    print(f"{'page':<22}{'encoder':<9}{'encode ms':>11}{'payload MB':>12}{'stub ms':>9}{'fits':>6}")
+    for name, image in pages().items():
+        for label, encoder in (("old", old_encode_page), ("new", encode_for_textract)):
+            elapsed, size = measure(encoder, image, args.repeat)
+            latency = stub_latency(size, args.stub_base_ms, args.stub_mbit)
+            fits = "yes" if size <= TEXTRACT_MAX_BYTES else "no"
+            print(f"{name:<22}{label:<9}{elapsed:>11.0f}{size / pow(10, 6):>12.2f}{latency:>9.0f}{fits:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,36 @@
 from dotenv import load_dotenv
-import os, requests, re, json, logging
+from concurrent.futures import ThreadPoolExecutor
+import os, re, json, logging, hashlib, copy, time, threading
+
+from services import mongodb as db, openai_client
+from extraction.rules import RuleExtractor
+from utils.idempotency import LRUCache
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-api_key = os.getenv("OPENAI_KEY")
+
+MODEL = "gpt-3.5-turbo"  # "gpt-4"
+MODEL_CONTEXT_TOKENS = {"gpt-3.5-turbo": 16385, "gpt-4": 8192}
+# * Tokens kept free for the completion, the rest of the context window is the prompt budget.
+RESPONSE_TOKENS = 4096
+# Documents above the budget are split into page windows which share this many pages with the previous window.
+CHUNK_OVERLAP_PAGES = 1
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 4))
+
+#! Bump PROMPT_VERSION whenever the prompt or the formats change, so cached results of the old prompt are not reused.
+PROMPT_VERSION = "2"
+cache_lru = LRUCache(int(os.getenv("EXTRACTION_CACHE_LRU_SIZE", 256)))
+cache_lock = threading.Lock()
+cache_stats = {"hits": 0, "misses": 0, "saved_seconds": 0.0}
+
+# * Short documents are first read by the local rule based extractor, the model is only called below RULES_MIN_CONFIDENCE.
+#! Off by default until its results have been measured against the model on real bills.
+RULES_ENABLED = os.getenv("RULES_ENABLED", "false").lower() == "true"
+RULES_MAX_PAGES = int(os.getenv("RULES_MAX_PAGES", 1))
+RULES_MIN_CONFIDENCE = float(os.getenv("RULES_MIN_CONFIDENCE", 1.0))
 
 regular_bill_format = {
     "invoices": [
@@ -152,25 +176,33 @@ notALineItems = [
 f = open(os.path.join(os.getcwd(), "extraction", "purposes.json"), "r")
 purposes = json.loads(f.read())
 
+rule_extractor = RuleExtractor(
+    keywords, utility_key_names, regular_bill_format, utility_bill_format
+)
+
+
+def compact(value) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
 
-def extract_entities(ocr_text: list, property_name=None):
 
-    prompt = f"""Given the invoices in the form of OCR text, analyze each page to identify information about an invoice.
+# * The instructions do not depend on the document, so they are built once at import and sent as the first message.
+# * An identical leading prefix on every call lets the provider reuse its prompt cache. Only the user message changes.
+STATIC_INSTRUCTIONS = f"""Given the invoices in the form of OCR text, analyze each page to identify information about an invoice.
 
-    1. Identify each invoice whether it is utility bill or regular bill. If Invoice contain this words {utility_key_names} consider it is utility invoice.
+    1. Identify each invoice whether it is utility bill or regular bill. If Invoice contain this words {compact(utility_key_names)} consider it is utility invoice.
         Note: It is mandatory to identify the invoice type.
 
     2. For each invoice, provide the result in the following formats:
-        If it is a utility invoice, use the format: {utility_bill_format}.
-        If it is a regular invoice, use the format: {regular_bill_format}.
+        If it is a utility invoice, use the format: {compact(utility_bill_format)}.
+        If it is a regular invoice, use the format: {compact(regular_bill_format)}.
 
-    3. If an entity is not found in above step, please use the keywords associated with each entity as given in this list to find the entity: {keywords} 
+    3. If an entity is not found in above step, please use the keywords associated with each entity as given in this list to find the entity: {compact(keywords)}
 
     4. Extract all the line items for each invoice and ensure that every individual item is identified and listed separately, these line items might be spanned across multiple pages.
-    
-    5. Use these purposes for line items: {purposes['regular']}. Do not include any purposes that are not listed.
 
-    6. Exclude the following description as line items: {notALineItems}
+    5. Use these purposes for line items: {compact(purposes['regular'])}. Do not include any purposes that are not listed.
+
+    6. Exclude the following description as line items: {compact(notALineItems)}
 
     7. List the page numbers in which the invoice is found.
 
@@ -178,33 +210,60 @@ def extract_entities(ocr_text: list, property_name=None):
 
     1. invoice_number should be unique.
 
-    2. vendor_name should not be {property_name} 
+    2. vendor_name should not be the property name given with the text.
 
     3. Do not print any analysis in output.
 
-    4. Give me result in json format only.
+    4. Give me result in json format only."""
+
+
+def build_prompt(ocr_text: list, property_name=None) -> str:
+    # The per document part of the prompt, appended after STATIC_INSTRUCTIONS.
+    return f"""Property name: {property_name}
 
-    Text: {ocr_text}
+    Text: {compact(ocr_text)}
 
     Entities:"""
 
-    response = requests.post(
-        url="https://api.openai.com/v1/chat/completions",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        },
-        json={
-            "model": "gpt-3.5-turbo",  # "gpt-4",
+
+def estimate_tokens(text: str) -> int:
+    # * Rough estimate, English text averages about 4 characters per token.
+    return len(text) // 4 + 1
+
+
+STATIC_PROMPT_TOKENS = estimate_tokens(STATIC_INSTRUCTIONS)
+
+
+def request_entities(ocr_text: list, property_name=None):
+    # Returns the list of invoices, or None when the request or the response failed.
+    # An empty list means the model found no invoice.
+    prompt = build_prompt(ocr_text, property_name)
+    dynamic_tokens = estimate_tokens(prompt)
+
+    response = openai_client.chat_completion(
+        {
+            "model": MODEL,
             "messages": [
-                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "system", "content": STATIC_INSTRUCTIONS},
                 {"role": "user", "content": prompt},
             ],
-        },
+        }
     )
 
+    if response is None:
+        logger.error("No response from GPT after retries %s", openai_client.metrics())
+        return None
+
     if response.status_code == 200:
         data = response.json()
+        usage: dict = data.get("usage", {})
+        logger.info(
+            "Prompt tokens: static %s, dynamic %s (estimated), total %s, cached %s",
+            STATIC_PROMPT_TOKENS,
+            dynamic_tokens,
+            usage.get("prompt_tokens"),
+            (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        )
         try:
             # Attempt to extract JSON content from the first structure
             content = data["choices"][0]["message"]["content"]
@@ -234,4 +293,163 @@ def extract_entities(ocr_text: list, property_name=None):
     else:
         logger.error("Error while getting response from GPT: %s", response.text)
 
-    return []
+    return None
+
+
+def chunk_pages(ocr_text: list, budget: int) -> list:
+    # Groups consecutive pages into windows under the token budget. A window starts on the last
+    # page(s) of the previous one so an invoice spanning the boundary is seen whole at least once.
+    pages = []
+    for page in ocr_text:
+        if estimate_tokens(compact(page)) <= budget:
+            pages.append(page)
+            continue
+        #! A single page above the budget is cut into parts that keep its page_number.
+        # The part size leaves room for the JSON around page_text, so every part fits the budget on its own.
+        overhead = estimate_tokens(compact({**page, "page_text": ""}))
+        size = max(1, (budget - overhead) * 4)
+        text = page["page_text"]
+        for start in range(0, len(text), size):
+            pages.append({**page, "page_text": text[start : start + size]})
+
+    windows, start = [], 0
+    while start < len(pages):
+        end, tokens = start, 0
+        while end < len(pages) and tokens + estimate_tokens(compact(pages[end])) <= budget:
+            tokens += estimate_tokens(compact(pages[end]))
+            end += 1
+        end = max(end, start + 1)
+        windows.append(pages[start:end])
+        if end >= len(pages):
+            break
+        start = max(end - CHUNK_OVERLAP_PAGES, start + 1)
+
+    return windows
+
+
+def merge_invoices(results: list) -> list:
+    # * Invoices found in several windows are merged by invoice_number: empty fields are filled,
+    # * page numbers are combined and line items that were not seen yet are appended.
+    merged, by_number = [], {}
+    for invoices in results:
+        for invoice in invoices or []:
+            if not isinstance(invoice, dict):
+                continue
+            number = str(invoice.get("invoice_number") or "").strip()
+            if not number or number not in by_number:
+                merged.append(invoice)
+                if number:
+                    by_number[number] = invoice
+                continue
+
+            existing = by_number[number]
+            for key, value in invoice.items():
+                if value and not existing.get(key):
+                    existing[key] = value
+
+            pages = set(existing.get("page_numbers") or []) | set(invoice.get("page_numbers") or [])
+            existing["page_numbers"] = sorted(pages, key=lambda n: int(n) if str(n).isdigit() else 0)
+
+            line_items = existing.get("line_items") or []
+            seen = {json.dumps(item, sort_keys=True) for item in line_items}
+            for item in invoice.get("line_items") or []:
+                if json.dumps(item, sort_keys=True) not in seen:
+                    line_items.append(item)
+            existing["line_items"] = line_items
+
+    return merged
+
+
+def extract_uncached(ocr_text: list, property_name=None):
+    # The token count is estimated before calling the model. Documents that fit go out in one request,
+    # longer ones are split into page windows which are extracted concurrently and merged.
+    # Returns None when any request failed, a partial merge would be cached as the full result.
+    budget = (
+        MODEL_CONTEXT_TOKENS.get(MODEL, 4096)
+        - RESPONSE_TOKENS
+        - STATIC_PROMPT_TOKENS
+        - estimate_tokens(build_prompt([], property_name))
+    )
+
+    if estimate_tokens(compact(ocr_text)) <= budget:
+        return request_entities(ocr_text, property_name)
+
+    windows = chunk_pages(ocr_text, budget)
+    logger.info("Splitting %s pages into %s windows", len(ocr_text), len(windows))
+
+    with ThreadPoolExecutor(max_workers=min(LLM_CONCURRENCY, len(windows))) as executor:
+        results = list(
+            executor.map(lambda window: request_entities(window, property_name), windows)
+        )
+
+    failed = sum(1 for invoices in results if invoices is None)
+    if failed:
+        logger.error("%s of %s windows failed, the document is not extracted", failed, len(windows))
+        return None
+
+    return merge_invoices(results)
+
+
+def cache_key(ocr_text: list, property_name=None) -> str:
+    # Whitespace is normalized so the same document OCRed again maps to the same key.
+    pages = [
+        [page.get("page_number"), " ".join(str(page.get("page_text", "")).split())]
+        for page in ocr_text
+    ]
+    raw = json.dumps([MODEL, PROMPT_VERSION, property_name, pages])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def cache_info() -> dict:
+    with cache_lock:
+        info = dict(cache_stats)
+    total = info["hits"] + info["misses"]
+    info["hit_rate"] = round(info["hits"] / total, 3) if total else 0.0
+    info["saved_seconds"] = round(info["saved_seconds"], 2)
+    return info
+
+
+def extract_entities(ocr_text: list, property_name=None):
+    if RULES_ENABLED and 0 < len(ocr_text) <= RULES_MAX_PAGES:
+        result = rule_extractor.extract(ocr_text)
+        logger.info("Rule based extraction confidence %s", result["confidence"])
+        if result["confidence"] >= RULES_MIN_CONFIDENCE:
+            return [result["invoice"]]
+
+    # * Results are cached in process (LRU) and in Mongo, keyed by the OCR text, property, model and prompt version.
+    key = cache_key(ocr_text, property_name)
+
+    cached = cache_lru.get(key)
+    if cached is None:
+        try:
+            cached = db.get_cached_extraction(key)
+        except Exception as error:
+            logger.error("Error while reading extraction cache: %s", error)
+        if cached is not None:
+            cache_lru.set(key, cached)
+
+    if cached is not None:
+        with cache_lock:
+            cache_stats["hits"] += 1
+            cache_stats["saved_seconds"] += cached["elapsed"]
+        logger.info("Extraction cache hit %s", cache_info())
+        return copy.deepcopy(cached["invoices"])
+
+    start = time.perf_counter()
+    invoices = extract_uncached(ocr_text, property_name)
+    elapsed = time.perf_counter() - start
+
+    with cache_lock:
+        cache_stats["misses"] += 1
+    logger.info("Extraction cache miss %s", cache_info())
+
+    # Failed extractions return None and are not cached, so the next attempt calls the model again.
+    if invoices:
+        cached = {"invoices": copy.deepcopy(invoices), "elapsed": elapsed}
+        cache_lru.set(key, cached)
+        try:
+            db.save_cached_extraction(key, cached["invoices"], elapsed)
+        except Exception as error:
+            logger.error("Error while saving extraction cache: %s", error)
+
+    return invoices
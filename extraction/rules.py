@@ -0,0 +1,162 @@
+import re, copy
+
+# * Deterministic header extraction built from the same keyword tables that gpt_modal pastes into the prompt.
+# * OCR lines are joined without separators (see services/aws.ocr_page), so value patterns stop at the first
+# * character that can not belong to the value instead of relying on line ends.
+
+SEPARATOR = r"\s*(?i:no\.?|number|num|#)?\s*[:#\-]?\s*"
+VALUE_PATTERNS = {
+    "invoice_number": r"(\d[\dA-Z\-/]*\d|\d|[A-Z]{1,4}-?\d[\dA-Z\-/]*\d)",
+    "invoice_date": (
+        r"(\d{1,2}[/\-.]\d{1,2}[/\-.]\d{2,4}"
+        r"|\d{4}-\d{2}-\d{2}"
+        r"|(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)[a-z]*\.?\s*\d{1,2},?\s*\d{4})"
+    ),
+    "amount": r"\$?\s*(\(?-?\$?\s*\d{1,3}(?:,\d{3})*\.\d{2}\)?)",
+    # Up to six capitalized words, e.g. "Acme Supply Co.", stopping before the next label ("... Invoice No").
+    "vendor_name": (
+        r"((?:(?!(?i:invoice|inv|bill|statement|date|amount|total|due|account|acct|customer|number|no)\b)"
+        r"[A-Z&][\w&'.,\-]*[ \t]*){1,6})"
+    ),
+}
+#! Without a vendor the result is never trusted, the model also fills address and line items.
+REQUIRED_FIELDS = ("invoice_number", "invoice_date", "invoice_amount", "vendor_name")
+
+# The prompt keywords "id" and "number" are too generic for a regex ("Account Number", "Customer ID").
+GENERIC_NUMBER_KEYWORDS = {"id", "number"}
+RULE_KEYWORDS = {
+    "vendor_name": ["vendor", "supplier", "remit to", "payable to", "sold by"],
+}
+# Numbers right after these words belong to something else than the invoice.
+OTHER_NUMBER_CONTEXT = re.compile(
+    r"(?i:account|acct|customer|cust|client|order|tax|phone|policy|member|routing|meter)\W*$"
+)
+# * Amount labels ranked from most to least likely to be the amount to pay, anything else ranks last.
+AMOUNT_RANKS = (
+    [
+        "total due",
+        "total amount due",
+        "total balance due",
+        "amount due",
+        "balance due",
+        "invoice total",
+        "grand total",
+        "amount payable",
+        "please pay",
+        "pay this amount",
+    ],
+    ["total", "total amount"],
+)
+# Amounts after these words are not the current invoice amount ("Previous Balance", "Sub Total").
+OTHER_AMOUNT_CONTEXT = re.compile(r"(?i:previous|prior|last|past|opening|sub|paid)\W*$")
+
+
+# A keyword starts after a non letter or at a lower to upper case change ("SuppliesInvoice"),
+# and ends before a non letter or an upper case letter ("InvoiceDate").
+KEYWORD_START = r"(?:(?<![A-Za-z])|(?<=[a-z])(?=[A-Z]))"
+KEYWORD_END = r"(?![a-z])"
+
+
+def keyword_pattern(words: list, value: str):
+    # Longer keywords first so "statement date" wins over "statement".
+    words = sorted({w.replace("_", " ").lower() for w in words}, key=len, reverse=True)
+    alternatives = "|".join(re.escape(w).replace(r"\ ", r"\s*") for w in words)
+    return re.compile(rf"{KEYWORD_START}(?i:{alternatives}){KEYWORD_END}{SEPARATOR}{value}")
+
+
+def normalize_amount(value: str) -> str:
+    # "$ 1,200.00" and "1200.00" are the same amount.
+    return re.sub(r"[\s$,]", "", value)
+
+
+def blank(template):
+    # Empty copy of an invoice format from gpt_modal, placeholders become "" and lists become [].
+    if isinstance(template, dict):
+        return {key: blank(value) for key, value in template.items()}
+    return [] if isinstance(template, list) else ""
+
+
+class RuleExtractor:
+    def __init__(self, keywords: dict, utility_key_names: list, regular_format: dict, utility_format: dict):
+        amount_fields = {"invoice_amount", "delivery_charges", "adjustments"}
+        keywords = {**keywords, **RULE_KEYWORDS}
+        keywords["invoice_number"] = [
+            w for w in keywords["invoice_number"] if w.lower() not in GENERIC_NUMBER_KEYWORDS
+        ]
+        keywords["invoice_amount"] = keywords["invoice_amount"] + [w for rank in AMOUNT_RANKS for w in rank]
+        # The field name itself ("invoice_date" -> "invoice date") is used as a keyword too.
+        self.patterns = {
+            field: keyword_pattern(
+                words + [field],
+                VALUE_PATTERNS["amount"] if field in amount_fields else VALUE_PATTERNS[field],
+            )
+            for field, words in keywords.items()
+        }
+        # Names like "Credit Balance (If we have credit from the vendor)" only match on the part before the note.
+        utility_names = [name.split("(")[0].strip() for name in utility_key_names]
+        self.utility_pattern = keyword_pattern(utility_names, "")
+        self.utility_amount_pattern = keyword_pattern(utility_names, VALUE_PATTERNS["amount"])
+        self.regular_template = blank(regular_format["invoices"][0])
+        self.utility_template = blank(utility_format["invoices"][0])
+
+    def invoice_numbers(self, text: str):
+        # Skips "Account Invoice ..." style matches where the keyword is part of another label.
+        for match in self.patterns["invoice_number"].finditer(text):
+            if not OTHER_NUMBER_CONTEXT.search(text[max(0, match.start() - 12) : match.start()]):
+                yield match
+
+    def amount_rank(self, text: str, match) -> int:
+        # The label is the keyword plus separator in front of the value, e.g. "Total Due ".
+        label = " ".join(text[match.start() : match.start(1)].lower().split()).rstrip(" :#-")
+        if OTHER_AMOUNT_CONTEXT.search(text[max(0, match.start() - 12) : match.start()]):
+            return len(AMOUNT_RANKS) + 1
+        for rank, words in enumerate(AMOUNT_RANKS):
+            if label in words:
+                return rank
+        return len(AMOUNT_RANKS)
+
+    def amounts(self, text: str) -> list:
+        # Every invoice_amount candidate, best first. Equal ranks keep the order of the document.
+        matches = self.patterns["invoice_amount"].finditer(text)
+        return sorted(matches, key=lambda match: (self.amount_rank(text, match), match.start()))
+
+    def search(self, field: str, text: str):
+        if field == "invoice_number":
+            return next(self.invoice_numbers(text), None)
+        if field == "invoice_amount":
+            return next(iter(self.amounts(text)), None)
+        return self.patterns[field].search(text)
+
+    def extract(self, ocr_text: list) -> dict:
+        # Returns {"invoice", "confidence"} for a document that is expected to hold a single invoice.
+        text = " ".join(str(page.get("page_text", "")) for page in ocr_text)
+        is_utility = bool(self.utility_pattern.search(text))
+
+        invoice = copy.deepcopy(self.utility_template if is_utility else self.regular_template)
+        invoice["invoice_type"] = "utility" if is_utility else "regular"
+        invoice["page_numbers"] = [page.get("page_number") for page in ocr_text]
+
+        for field, pattern in self.patterns.items():
+            match = self.search(field, text)
+            if match and field in invoice:
+                invoice[field] = match.group(1).strip()
+
+        if is_utility:
+            # * For utility bills the current charges are the invoice amount, same rule as in the prompt.
+            match = self.utility_amount_pattern.search(text)
+            if match:
+                invoice["invoice_amount"] = match.group(1).strip()
+
+        confidence = sum(1 for f in REQUIRED_FIELDS if invoice.get(f)) / len(REQUIRED_FIELDS)
+
+        #! Several different invoice numbers usually mean several invoices in one file, leave those to the model.
+        numbers = {m.group(1) for m in self.invoice_numbers(text)}
+        if len(numbers) > 1:
+            confidence /= 2
+
+        #! Same for amounts, "Previous Balance" next to "Total Due" or "Net Amount" next to "Total" can not be told apart safely.
+        amounts = {normalize_amount(m.group(1)) for m in self.amounts(text)}
+        if len(amounts) > 1:
+            confidence /= 2
+
+        return {"invoice": invoice, "confidence": round(confidence, 2)}
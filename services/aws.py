@@ -1,7 +1,12 @@
 from dotenv import load_dotenv
 import boto3
-from pdf2image import convert_from_bytes
-import os, io, mimetypes
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from pdf2image import convert_from_path, pdfinfo_from_path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os, io, mimetypes, time, random, threading, tempfile, subprocess
+from utils.images import encode_for_textract
 
 load_dotenv()
 
@@ -9,12 +14,50 @@ S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 aws_access_key_id = os.getenv("boto3_aws_access_key_id")
 aws_secret_access_key = os.getenv("boto3_aws_secret_access_key")
 region_name = os.getenv("boto3_region_name")
+# * Point this at a local S3 stand-in (MinIO, moto server) for development and tests.
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+
+# * Files of one email are uploaded by S3_UPLOAD_CONCURRENCY threads.
+# * Files over the threshold go up as multipart uploads, S3_PART_CONCURRENCY parts at a time.
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", 4))
+S3_PART_CONCURRENCY = int(os.getenv("S3_PART_CONCURRENCY", 4))
+MB = 1024 * 1024
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD_MB", 16)) * MB
+S3_MULTIPART_CHUNKSIZE = int(os.getenv("S3_MULTIPART_CHUNKSIZE_MB", 8)) * MB
+
+# * Pages of one PDF are sent to Textract by this many threads. 1 keeps the old sequential behaviour.
+TEXTRACT_CONCURRENCY = int(os.getenv("TEXTRACT_CONCURRENCY", 4))
+#! DetectDocumentText has a per account TPS quota (check the Service Quotas console for the region).
+TEXTRACT_TPS = float(os.getenv("TEXTRACT_TPS", 5))
+TEXTRACT_RETRIES = 5
+THROTTLING_ERRORS = (
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+)
+
+# * Pages are rasterized OCR_RENDER_WINDOW at a time, so memory depends on the window and not on the page count.
+OCR_DPI = int(os.getenv("OCR_DPI", 200))
+OCR_GRAYSCALE = os.getenv("OCR_GRAYSCALE", "false").lower() == "true"
+OCR_RENDER_WINDOW = int(os.getenv("OCR_RENDER_WINDOW", 2))
+
+# * Pages whose embedded text layer has at least this many non blank characters skip rendering and Textract.
+OCR_MIN_TEXT_CHARS = int(os.getenv("OCR_MIN_TEXT_CHARS", 100))
 
 s3client = boto3.client(
     "s3",
     aws_access_key_id=aws_access_key_id,
     aws_secret_access_key=aws_secret_access_key,
     region_name=region_name,
+    endpoint_url=S3_ENDPOINT_URL,
+    # Enough connections for every file and part uploading at the same time.
+    config=Config(max_pool_connections=max(10, S3_UPLOAD_CONCURRENCY * S3_PART_CONCURRENCY)),
+)
+
+transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_PART_CONCURRENCY,
 )
 
 textract_client = boto3.client(
@@ -22,60 +65,266 @@ textract_client = boto3.client(
     aws_access_key_id=aws_access_key_id,
     aws_secret_access_key=aws_secret_access_key,
     region_name=region_name,
+    # Throttling is retried in detect_page_text, one connection per OCR thread.
+    config=Config(
+        max_pool_connections=max(10, TEXTRACT_CONCURRENCY),
+        retries={"max_attempts": 1},
+    ),
 )
 
+
+class RateLimiter:
+    # Spaces calls at least 1/rate seconds apart across all threads of the process.
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+textract_limiter = RateLimiter(TEXTRACT_TPS)
+
 # * Implemented the function as standalone because we don't require a class for its implementation
 
 
-def upload_to_s3(content: bytes, key):
+def content_key(prefix: str, content_hash: str, ext: str = ".pdf") -> str:
+    # Objects are keyed by the sha256 of their bytes, so the same file is stored once per prefix.
+    return f"{prefix}/{content_hash}{ext}"
+
+
+def object_exists(key) -> bool:
+    try:
+        s3client.head_object(Bucket=S3_BUCKET_NAME, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def upload_blob(content: bytes, key):
+    # Private pipeline blobs (services/blobstore.py). Keys are content hashes, so an existing key is not uploaded again.
+    if object_exists(key):
+        return
+    s3client.upload_fileobj(
+        Fileobj=io.BytesIO(content),
+        Bucket=S3_BUCKET_NAME,
+        Key=key,
+        Config=transfer_config,
+    )
+
+
+def download_from_s3(key) -> bytes:
+    res = s3client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+    return res["Body"].read()
+
+
+def upload_to_s3(content: bytes, key, skip_existing: bool = False) -> bool:
+    # Returns False when skip_existing is set and the key is already in the bucket.
+    if skip_existing and object_exists(key):
+        return False
+
     contentType, _ = mimetypes.guess_type(key)
-    buf = io.BytesIO()
-    buf.write(content)
-    buf.seek(0)
+    # BytesIO over bytes shares the buffer, the file is not copied.
     s3client.upload_fileobj(
-        Fileobj=buf,
+        Fileobj=io.BytesIO(content),
         Bucket=S3_BUCKET_NAME,
         Key=key,
         ExtraArgs={"ACL": "public-read", "ContentType": contentType},
+        Config=transfer_config,
     )
+    return True
 
 
-def get_ocr_text(content: bytes):
-    all_text = []
-    images = []
+def copy_in_s3(source_key, key, skip_existing: bool = False) -> bool:
+    # Server side copy, the bytes do not pass through this process. Returns False like upload_to_s3.
+    if skip_existing and object_exists(key):
+        return False
 
+    contentType, _ = mimetypes.guess_type(key)
+    s3client.copy(
+        CopySource={"Bucket": S3_BUCKET_NAME, "Key": source_key},
+        Bucket=S3_BUCKET_NAME,
+        Key=key,
+        ExtraArgs={"ACL": "public-read", "ContentType": contentType, "MetadataDirective": "REPLACE"},
+        Config=transfer_config,
+    )
+    return True
+
+
+def upload_many(files: list, skip_existing: bool = True) -> list:
+    # Uploads (content, key, source_key) items concurrently. Returns None per uploaded or existing file, the exception otherwise.
+    # * When source_key is set the same bytes are already in the bucket there and are copied instead of uploaded.
+    def upload(file):
+        content, key, source_key = file if len(file) == 3 else (*file, None)
+        try:
+            if source_key:
+                try:
+                    copy_in_s3(source_key=source_key, key=key, skip_existing=skip_existing)
+                    return None
+                except ClientError as e:
+                    # The source blob may have expired already, the bytes are still here.
+                    print("Error while copying", source_key, "to", key, e)
+            upload_to_s3(content=content, key=key, skip_existing=skip_existing)
+            return None
+        except Exception as e:
+            print("Error while uploading", key, e)
+            return e
+
+    if not files:
+        return []
+    with ThreadPoolExecutor(max_workers=min(S3_UPLOAD_CONCURRENCY, len(files))) as executor:
+        return list(executor.map(upload, files))
+
+
+def detect_page_text(img_data: bytes) -> dict:
+    # Retries throttled calls with exponential backoff and jitter, other errors are raised.
+    for attempt in range(TEXTRACT_RETRIES):
+        textract_limiter.wait()
+        try:
+            return textract_client.detect_document_text(Document={"Bytes": img_data})
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in THROTTLING_ERRORS or attempt == TEXTRACT_RETRIES - 1:
+                raise
+            time.sleep(min(2**attempt, 20) * random.uniform(0.5, 1))
+
+
+def ocr_page(index: int, image):
+    start = time.perf_counter()
     try:
-        # --- Note: Ensure that poppler is installed on the system and its path is added to the environment variables
-        images = convert_from_bytes(content)
+        res = detect_page_text(encode_for_textract(image))
     except Exception as e:
-        print("Convert convert pdf to images", e)
+        print("OCR failed for page", index + 1, e)
+        return None
+    finally:
+        print(f"OCR page {index + 1}: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    status = res["ResponseMetadata"]["HTTPStatusCode"]
+
+    if status == 200:
+        page_text = ""
+        for block in res["Blocks"]:
+            if block["BlockType"] == "LINE":
+                page_text += block["Text"]
+        return {"page_number": index + 1, "page_text": page_text}
+
+    print("OCR response", res)
+    return None
+
+
+def page_windows(page_numbers: list, window: int):
+    # Splits page numbers into runs of consecutive pages with at most "window" pages each.
+    run = []
+    for page_number in page_numbers:
+        if run and (page_number != run[-1] + 1 or len(run) == window):
+            yield run
+            run = []
+        run.append(page_number)
+    if run:
+        yield run
 
+
+def iter_pdf_pages(
+    pdf_path: str,
+    page_numbers: list,
+    dpi: int = OCR_DPI,
+    grayscale: bool = OCR_GRAYSCALE,
+    window: int = OCR_RENDER_WINDOW,
+):
+    # * Yields (index, image) one rendering window at a time. index is 0 based like enumerate(images).
+    # --- Note: Ensure that poppler is installed on the system and its path is added to the environment variables
+    for run in page_windows(page_numbers, max(1, window)):
+        images = convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            grayscale=grayscale,
+            first_page=run[0],
+            last_page=run[-1],
+        )
+        for page_number, image in zip(run, images):
+            yield page_number - 1, image
+        del images
+
+
+def get_text_layer(pdf_path: str, page_count: int) -> list:
+    # pdftotext ships with poppler (same as pdf2image) and separates pages with a form feed.
     try:
-        for index, image in enumerate(images):
-            buffer = io.BytesIO()
-            image.save(buffer, format="jpeg", subsampling=0, quality=90)
-            img_data = buffer.getvalue()
-            img_size_mb = len(img_data) / pow(10, 6)
-
-            if img_size_mb >= 10:
-                buffer = io.BytesIO()
-                image.save(buffer, format="jpeg", subsampling=0, quality=50)
-                img_data = buffer.getvalue()
-
-            res = textract_client.detect_document_text(Document={"Bytes": img_data})
-
-            status = res["ResponseMetadata"]["HTTPStatusCode"]
-
-            if status == 200:
-                page_text = ""
-                for block in res["Blocks"]:
-                    if block["BlockType"] == "LINE":
-                        page_text += block["Text"]
-                all_text.append({"page_number": index + 1, "page_text": page_text})
+        result = subprocess.run(
+            ["pdftotext", "-enc", "UTF-8", pdf_path, "-"],
+            capture_output=True,
+            check=True,
+            timeout=60,
+        )
+    except Exception as e:
+        print("Error while reading pdf text layer", e)
+        return [""] * page_count
+
+    pages = result.stdout.decode("utf-8", errors="ignore").split("\f")
+    pages = (pages + [""] * page_count)[:page_count]
+    # * Lines are joined the same way as the Textract LINE blocks in ocr_page.
+    return ["".join(line.strip() for line in page.splitlines()) for page in pages]
+
+
+def get_ocr_text(
+    content: bytes, concurrency: int = TEXTRACT_CONCURRENCY, page_sources: list = None
+):
+    # * page_sources, when given, is filled with {"page_number", "source"} where source is "text_layer" or "ocr".
+    pages = {}
+    pending = set()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pdf_path = os.path.join(temp_dir, "document.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(content)
+
+        try:
+            page_count = pdfinfo_from_path(pdf_path)["Pages"]
+        except Exception as e:
+            print("Convert convert pdf to images", e)
+            return []
+
+        # Digitally generated pages already carry their text, only image pages go to Textract.
+        ocr_pages = []
+        for index, page_text in enumerate(get_text_layer(pdf_path, page_count)):
+            if len("".join(page_text.split())) >= OCR_MIN_TEXT_CHARS:
+                pages[index] = {"page_number": index + 1, "page_text": page_text}
             else:
-                print("OCR response", res)
+                ocr_pages.append(index + 1)
 
-    except Exception as e:
-        print("OCR failed", e)
+        # * Rendering and OCR are pipelined: at most "concurrency" pages wait on Textract while the next window is rendered.
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            try:
+                for index, image in iter_pdf_pages(pdf_path, ocr_pages):
+                    if concurrency <= 1:
+                        pages[index] = ocr_page(index, image)
+                        continue
+
+                    if len(pending) >= concurrency:
+                        _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    future = executor.submit(ocr_page, index, image)
+                    pending.add(future)
+                    pages[index] = future
+            except Exception as e:
+                print("Convert convert pdf to images", e)
+
+    print(f"Text layer pages: {page_count - len(ocr_pages)}/{page_count}")
+    if page_sources is not None:
+        page_sources.extend(
+            {
+                "page_number": index + 1,
+                "source": "ocr" if index + 1 in ocr_pages else "text_layer",
+            }
+            for index in range(page_count)
+        )
 
-    return all_text
+    pages = [pages[index] for index in sorted(pages)]
+    pages = [page.result() if hasattr(page, "result") else page for page in pages]
+    return [page for page in pages if page]
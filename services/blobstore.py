@@ -0,0 +1,67 @@
+from dotenv import load_dotenv
+import os, hashlib, tempfile
+
+from services import aws
+
+load_dotenv()
+
+# * Claim check for the Celery pipeline: file bytes are stored once and only the reference travels through RabbitMQ.
+# * References look like "s3:<key>" or "local:<sha256>". "local" is meant for development and tests on one machine.
+BLOB_STORE = os.getenv("BLOB_STORE", "s3")
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(tempfile.gettempdir(), "bill_blobs"))
+#! Add a lifecycle rule on this prefix in the bucket, the blobs are only needed while the tasks run.
+BLOB_PREFIX = os.getenv("BLOB_PREFIX", "blobs")
+
+
+def local_path(digest: str) -> str:
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+def put(content: bytes) -> str:
+    # Keys are content hashes, so storing the same bytes twice is a no-op.
+    digest = hashlib.sha256(content).hexdigest()
+
+    if BLOB_STORE == "local":
+        path = local_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written to a temp file first so a reader never sees a half written blob.
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                f.write(content)
+            os.replace(f.name, path)
+        return f"local:{digest}"
+
+    key = f"{BLOB_PREFIX}/{digest}"
+    aws.upload_blob(content=content, key=key)
+    return f"s3:{key}"
+
+
+def s3_key(ref: str) -> str:
+    # The bucket key behind a reference, None for local blobs.
+    scheme, _, name = ref.partition(":")
+    return name if scheme == "s3" else None
+
+
+def ref_for_s3_object(content: bytes, key: str) -> str:
+    # Bytes that were just uploaded to the bucket under key are read back from there instead of being stored twice.
+    if BLOB_STORE == "s3":
+        return f"s3:{key}"
+    return put(content)
+
+
+def get(ref: str) -> bytes:
+    scheme, _, name = ref.partition(":")
+    if scheme == "local":
+        with open(local_path(name), "rb") as f:
+            return f.read()
+    if scheme == "s3":
+        return aws.download_from_s3(key=name)
+    raise ValueError(f"Unknown blob reference: {ref}")
+
+
+def load_attachments(attachments: list) -> list:
+    # Resolves {"filename", "blob_ref"} entries to the {"filename", "content_bytes"} shape FileHandler expects.
+    return [
+        {**a, "content_bytes": get(a["blob_ref"])} if "blob_ref" in a else a
+        for a in attachments
+    ]
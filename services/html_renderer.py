@@ -0,0 +1,123 @@
+from dotenv import load_dotenv
+import pdfkit
+import os, re, html, shutil, subprocess, threading, time
+
+from utils.http import CallStats
+
+load_dotenv()
+
+# * Renders email bodies to PDF for mails without attachments.
+#! wkhtmltopdf has no server mode, every render is still one process. What is shared is the configuration
+#! (the binary is looked up once) and a limit of HTML_RENDER_WORKERS renders at a time per process.
+#! Each render runs in the calling thread and is killed after HTML_RENDER_TIMEOUT seconds.
+WKHTMLTOPDF_PATH = os.getenv("WKHTMLTOPDF_PATH", shutil.which("wkhtmltopdf") or "")
+HTML_RENDER_WORKERS = int(os.getenv("HTML_RENDER_WORKERS", 2))
+HTML_RENDER_TIMEOUT = int(os.getenv("HTML_RENDER_TIMEOUT", 60))
+HTML_MAX_BYTES = int(os.getenv("HTML_MAX_BYTES", 5 * pow(10, 6)))
+# Bodies with less visible text than this and no images are not worth a PDF.
+HTML_MIN_TEXT_CHARS = int(os.getenv("HTML_MIN_TEXT_CHARS", 20))
+
+OPTIONS = {
+    "encoding": "UTF-8",
+    "disable-javascript": "",
+    "load-error-handling": "ignore",
+    "load-media-error-handling": "ignore",
+}
+
+HIDDEN_BLOCKS = re.compile(r"<(style|script|head)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+TAGS = re.compile(r"<[^>]+>")
+IMAGES = re.compile(r"<img\b", re.IGNORECASE)
+
+
+def visible_text(body_html: str) -> str:
+    text = TAGS.sub(" ", HIDDEN_BLOCKS.sub(" ", body_html))
+    return " ".join(html.unescape(text).split())
+
+
+def is_trivial(body_html: str) -> bool:
+    if not body_html:
+        return True
+    return len(visible_text(body_html)) < HTML_MIN_TEXT_CHARS and not IMAGES.search(body_html)
+
+
+class HtmlRenderer:
+    def __init__(self):
+        # pdfkit.configuration() runs "which wkhtmltopdf" every time, so it is built once here.
+        self.configuration = pdfkit.configuration(wkhtmltopdf=WKHTMLTOPDF_PATH)
+        self.slots = threading.BoundedSemaphore(HTML_RENDER_WORKERS)
+        self.stats = CallStats()
+        self.counters_lock = threading.Lock()
+        self.counters = {"rendered": 0, "skipped": 0, "too_large": 0, "queue_full": 0, "failed": 0}
+
+    def count(self, key: str):
+        with self.counters_lock:
+            self.counters[key] += 1
+
+    def _render(self, body_html: str) -> bytes:
+        with self.stats.timer("render"):
+            kit = pdfkit.PDFKit(body_html, "string", options=OPTIONS, configuration=self.configuration)
+            result = subprocess.run(
+                kit.command(),
+                input=body_html.encode("utf-8"),
+                capture_output=True,
+                timeout=HTML_RENDER_TIMEOUT,
+            )
+            stderr = (result.stderr or b"").decode("utf-8", errors="replace")
+            pdfkit.PDFKit.handle_error(result.returncode, stderr)
+            return result.stdout
+
+    def render(self, body_html: str) -> bytes:
+        # Returns the PDF bytes, or None when the body was skipped or could not be rendered.
+        if is_trivial(body_html):
+            self.count("skipped")
+            return None
+
+        if len(body_html.encode("utf-8")) > HTML_MAX_BYTES:
+            print("Email body is too large to render:", len(body_html))
+            self.count("too_large")
+            return None
+
+        if not self.slots.acquire(timeout=HTML_RENDER_TIMEOUT):
+            print("Html render queue is full")
+            self.count("queue_full")
+            return None
+
+        start = time.perf_counter()
+        try:
+            content = self._render(body_html)
+        except (subprocess.TimeoutExpired, IOError) as e:
+            print("Error while rendering email body:", e)
+            content = None
+        finally:
+            self.slots.release()
+
+        self.count("rendered" if content else "failed")
+        # The renders run in the Celery workers, so their metrics are logged here instead of served by the API.
+        print(f"Html render took {time.perf_counter() - start:.2f}s", self.metrics())
+        return content or None
+
+    def metrics(self) -> dict:
+        with self.counters_lock:
+            result = dict(self.counters)
+        result["latency"] = self.stats.snapshot()
+        return result
+
+
+_renderer: HtmlRenderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer() -> HtmlRenderer:
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = HtmlRenderer()
+        return _renderer
+
+
+def render(body_html: str) -> bytes:
+    return get_renderer().render(body_html)
+
+
+def metrics() -> dict:
+    return get_renderer().metrics()
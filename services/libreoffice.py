@@ -0,0 +1,257 @@
+from dotenv import load_dotenv
+import os, time, queue, shutil, socket, subprocess, tempfile, threading, atexit
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import List, Tuple
+
+load_dotenv()
+
+# * Office documents are converted by a pool of long lived headless LibreOffice instances (unoserver),
+# * each with its own user profile, instead of a cold "soffice --convert-to" per document.
+# * Without unoserver installed (pip install unoserver) the pool falls back to soffice, still one profile per slot.
+LIBREOFFICE_PATH = os.getenv(
+    "LIBREOFFICE_PATH",
+    shutil.which("soffice") or r"C:\\Program Files\\LibreOffice\\program\\soffice.exe",
+)
+#! unoserver has to run with a python that can "import uno" (the one shipped with LibreOffice or python3-uno).
+UNOSERVER_PATH = os.getenv("UNOSERVER_PATH", "unoserver")
+LIBREOFFICE_POOL_SIZE = int(os.getenv("LIBREOFFICE_POOL_SIZE", 2))
+# * 0 picks free ports for every instance, so the API, each Celery worker and its children never collide.
+# * A fixed base only fits a single process on the host.
+LIBREOFFICE_BASE_PORT = int(os.getenv("LIBREOFFICE_BASE_PORT", 0))
+LIBREOFFICE_TIMEOUT = int(os.getenv("LIBREOFFICE_TIMEOUT", 120))
+LIBREOFFICE_START_TIMEOUT = 60
+PROFILE_ROOT = os.getenv(
+    "LIBREOFFICE_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "libreoffice_pool")
+)
+
+try:
+    from unoserver.client import UnoClient
+except ImportError:
+    UnoClient = None
+
+#! Set once a unoserver instance fails to start (e.g. its python can not "import uno"), the process then uses soffice.
+unoserver_failed = threading.Event()
+
+
+# unoserver only gets the bytes. Binary formats are detected from their content, plain text needs
+# its import filter or a .csv would open in Writer instead of Calc.
+INPUT_FILTERS = {
+    ".csv": "Text - txt - csv (StarCalc)",
+    ".txt": "Text",
+}
+
+
+def use_unoserver() -> bool:
+    return UnoClient is not None and not unoserver_failed.is_set()
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class OfficeInstance:
+    # One slot of the pool: a unoserver process (or only a profile dir in soffice mode) with its own ports.
+    def __init__(self, index: int):
+        self.index = index
+        self.port = None
+        self.uno_port = None
+        self.process: subprocess.Popen = None
+
+    @property
+    def profile(self) -> str:
+        # One profile per process and slot, LibreOffice locks its profile directory.
+        return os.path.join(PROFILE_ROOT, f"profile_{os.getpid()}_{self.index}")
+
+    def profile_url(self) -> str:
+        return "file:///" + self.profile.replace("\\", "/").lstrip("/")
+
+    def assign_ports(self):
+        if LIBREOFFICE_BASE_PORT:
+            self.port = LIBREOFFICE_BASE_PORT + 2 * self.index
+            self.uno_port = self.port + 1
+        else:
+            self.port, self.uno_port = free_port(), free_port()
+
+    def healthy(self) -> bool:
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(("127.0.0.1", self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def start(self):
+        os.makedirs(self.profile, exist_ok=True)
+        self.assign_ports()
+        command = [
+            UNOSERVER_PATH,
+            "--interface", "127.0.0.1",
+            "--port", str(self.port),
+            "--uno-port", str(self.uno_port),
+            "--executable", LIBREOFFICE_PATH,
+            "--user-installation", self.profile_url(),
+            "--conversion-timeout", str(LIBREOFFICE_TIMEOUT),
+        ]
+        # A new session so stop() can kill soffice together with unoserver.
+        self.process = subprocess.Popen(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=os.name != "nt",
+        )
+
+        deadline = time.monotonic() + LIBREOFFICE_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.healthy():
+                return
+            if self.process.poll() is not None:
+                break
+            time.sleep(0.5)
+        raise RuntimeError(f"LibreOffice instance {self.index} did not start")
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            if os.name != "nt":
+                os.killpg(self.process.pid, 9)
+            else:
+                self.process.kill()
+            self.process.wait(timeout=10)
+        except Exception as e:
+            print("Error while stopping LibreOffice instance", self.index, e)
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def convert(self, buffer: bytes, name: str, ext: str) -> bytes:
+        if not use_unoserver():
+            return self.convert_with_soffice([(buffer, name, ext)])[0]
+
+        if not self.healthy():
+            try:
+                self.restart()
+            except (RuntimeError, OSError) as e:
+                print("unoserver did not start, converting with soffice from now on:", e)
+                unoserver_failed.set()
+                self.stop()
+                return self.convert_with_soffice([(buffer, name, ext)])[0]
+
+        client = UnoClient(server="127.0.0.1", port=str(self.port))
+        # The server has its own conversion timeout, this one also covers a hung RPC connection.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(
+                client.convert,
+                indata=buffer,
+                convert_to="pdf",
+                infiltername=INPUT_FILTERS.get(ext.lower()),
+            )
+            try:
+                return future.result(timeout=LIBREOFFICE_TIMEOUT + 10)
+            except FutureTimeout:
+                self.stop()
+                raise
+
+    def convert_with_soffice(self, files: List[Tuple[bytes, str, str]]) -> List[bytes]:
+        # One soffice run converts every file of the batch, so the start up cost is paid once.
+        #! Note It delete the files after some period.
+        os.makedirs(self.profile, exist_ok=True)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Prefixed with the position so files with the same name do not overwrite each other.
+            names = [f"{position}-{name}" for position, (_, name, _) in enumerate(files)]
+            paths = []
+            for (buffer, _, ext), name in zip(files, names):
+                path = os.path.join(temp_dir, f"{name}{ext}")
+                with open(path, "wb") as temp_file:
+                    temp_file.write(buffer)
+                paths.append(path)
+
+            out_dir = os.path.join(temp_dir, "out")
+            command = [
+                LIBREOFFICE_PATH,
+                f"-env:UserInstallation={self.profile_url()}",
+                "--headless",
+                "--convert-to",
+                "pdf",
+                "--outdir",
+                out_dir,
+                *paths,
+            ]
+            try:
+                subprocess.run(command, check=True, timeout=LIBREOFFICE_TIMEOUT * len(paths))
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+                print(f"Conversion failed: {e}")
+
+            outputs = []
+            for name in names:
+                out_path = os.path.join(out_dir, f"{name}.pdf")
+                if os.path.exists(out_path):
+                    with open(out_path, "rb") as f:
+                        outputs.append(f.read())
+                else:
+                    outputs.append(None)
+            return outputs
+
+
+class OfficePool:
+    def __init__(self, size: int):
+        self.idle = queue.Queue()
+        for index in range(size):
+            self.idle.put(OfficeInstance(index))
+
+    def convert(self, buffer: bytes, name: str, ext: str) -> bytes:
+        # Returns the PDF bytes, or None when the conversion failed or timed out.
+        instance: OfficeInstance = self.idle.get()
+        try:
+            return instance.convert(buffer, name, ext)
+        except Exception as e:
+            print(f"Conversion failed: {e}")
+            # Restarted on next use by the health check.
+            instance.stop()
+            return None
+        finally:
+            self.idle.put(instance)
+
+    def convert_many(self, files: List[Tuple[bytes, str, str]]) -> List[bytes]:
+        # Converts (buffer, name, ext) items, results come back in the same order.
+        if not files:
+            return []
+        if not use_unoserver():
+            instance: OfficeInstance = self.idle.get()
+            try:
+                return instance.convert_with_soffice(files)
+            finally:
+                self.idle.put(instance)
+
+        with ThreadPoolExecutor(max_workers=min(self.idle.qsize() or 1, len(files))) as executor:
+            return list(executor.map(lambda file: self.convert(*file), files))
+
+    def shutdown(self):
+        while not self.idle.empty():
+            self.idle.get().stop()
+
+
+_pool: OfficePool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> OfficePool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OfficePool(LIBREOFFICE_POOL_SIZE)
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def convert(buffer: bytes, name: str, ext: str) -> bytes:
+    return get_pool().convert(buffer, name, ext)
+
+
+def convert_many(files: List[Tuple[bytes, str, str]]) -> List[bytes]:
+    return get_pool().convert_many(files)
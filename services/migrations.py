@@ -0,0 +1,68 @@
+from pymongo import UpdateOne
+
+from services.mongodb import (
+    email_table,
+    file_table,
+    email_bodies,
+    ocr_results,
+    save_payloads,
+    ocr_fields,
+)
+
+# * One off data migrations. Run with: python -m services.migrations
+# * Each step only picks documents that still have the old shape, so an interrupted run can simply be started again.
+BATCH_SIZE = 500
+
+
+def move_email_bodies():
+    # email_table.body -> email_bodies, the email keeps body_size.
+    moved = 0
+    while True:
+        docs = list(email_table.find({"body": {"$exists": True}}, {"body": 1}).limit(BATCH_SIZE))
+        if not docs:
+            return moved
+
+        save_payloads(email_bodies, [(doc["_id"], doc["body"]) for doc in docs if doc["body"] is not None])
+        updates = []
+        for doc in docs:
+            body = doc["body"]
+            updates.append(
+                UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$unset": {"body": ""}, "$set": {"body_size": len(body or "")}},
+                )
+            )
+        email_table.bulk_write(updates, ordered=False)
+        moved += len(docs)
+        print("Email bodies moved:", moved)
+
+
+def move_ocr_responses():
+    # file_table.ocr_response -> ocr_results. The body copied into file rows is dropped, email_bodies has it.
+    moved = 0
+    while True:
+        docs = list(
+            file_table.find(
+                {"$or": [{"ocr_response": {"$exists": True}}, {"body": {"$exists": True}}]},
+                {"ocr_response": 1, "ocr_sources": 1, "body": 1},
+            ).limit(BATCH_SIZE)
+        )
+        if not docs:
+            return moved
+
+        with_ocr = [doc for doc in docs if "ocr_response" in doc]
+        save_payloads(ocr_results, [(doc["_id"], doc["ocr_response"] or []) for doc in with_ocr])
+        updates = []
+        for doc in docs:
+            update = {"$unset": {"ocr_response": "", "body": ""}}
+            if "ocr_response" in doc:
+                update["$set"] = ocr_fields(doc["ocr_response"] or [], doc.get("ocr_sources"))
+            updates.append(UpdateOne({"_id": doc["_id"]}, update))
+        file_table.bulk_write(updates, ordered=False)
+        moved += len(docs)
+        print("File rows migrated:", moved)
+
+
+if __name__ == "__main__":
+    move_email_bodies()
+    move_ocr_responses()
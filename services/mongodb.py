@@ -1,7 +1,11 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel, UpdateOne, ReplaceOne, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
 from dotenv import load_dotenv
 import os
-from bson import ObjectId
+import gridfs
+from bson import ObjectId, Binary
+from datetime import datetime
+from utils import serializer
 
 load_dotenv()
 uri = os.getenv("db_uri")
@@ -13,26 +17,143 @@ email_table = db["email_table"]
 file_table = db["file_table"]
 invoice_table = db["invoice_table"]
 bills_table = db["bills_table"]
+sync_state = db["sync_state"]
+processed_keys = db["processed_keys"]
+content_index = db["content_index"]
+extraction_cache = db["extraction_cache"]
+# * Large payloads live outside the hot documents: email bodies keyed by the email_table _id,
+# * OCR text keyed by the file_table _id. Stored msgpack + zstd (utils/serializer.py).
+email_bodies = db["email_bodies"]
+ocr_results = db["ocr_results"]
+payload_fs = gridfs.GridFS(db, collection="payload_fs")
+
+# * Claimed keys (webhook message ids) expire after this many seconds through a TTL index.
+PROCESSED_KEYS_TTL = int(os.getenv("PROCESSED_KEYS_TTL", 3 * 24 * 60 * 60))
+# * Cached LLM extractions expire after EXTRACTION_CACHE_TTL seconds, and the oldest are dropped above EXTRACTION_CACHE_MAX_DOCS.
+EXTRACTION_CACHE_TTL = int(os.getenv("EXTRACTION_CACHE_TTL", 30 * 24 * 60 * 60))
+EXTRACTION_CACHE_MAX_DOCS = int(os.getenv("EXTRACTION_CACHE_MAX_DOCS", 100000))
+#! Documents are capped at 16MB, compressed payloads above this size go to GridFS instead.
+PAYLOAD_GRIDFS_BYTES = int(os.getenv("PAYLOAD_GRIDFS_BYTES", 8 * 1024 * 1024))
+
+# * Every index the app relies on, by collection. ensure_indexes() creates the missing ones at startup.
+#! Changing the options of an existing index (e.g. a TTL) needs the old index dropped by hand first.
+INDEXES = {
+    "email_table": [
+        IndexModel([("microsoft_id", ASCENDING)]),
+        IndexModel([("client", ASCENDING), ("property", ASCENDING), ("timestamp", DESCENDING)]),
+    ],
+    "file_table": [
+        IndexModel([("email_table_id", ASCENDING)]),
+        IndexModel([("s3_key", ASCENDING)]),
+        IndexModel([("content_hash", ASCENDING)]),
+        IndexModel([("duplicate_of", ASCENDING)], sparse=True),
+        IndexModel([("client", ASCENDING), ("property", ASCENDING), ("timestamp", DESCENDING)]),
+    ],
+    "processed_keys": [
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=PROCESSED_KEYS_TTL),
+    ],
+    "extraction_cache": [
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=EXTRACTION_CACHE_TTL),
+    ],
+}
 
 # * Implemented the function as standalone because we don't require a class for its implementation
 ###! Note:Ensure that a shallow copy of the data is made before every insert operation.
 
 
+def save_payloads(collection, items: list, replace: bool = True):
+    # Stores (_id, value) items. Small payloads are written inline with one bulk_write,
+    # large ones go to GridFS under the same _id. replace=False skips the lookup for ids that can not exist yet.
+    if not items:
+        return
+
+    in_gridfs = set()
+    if replace:
+        # An old GridFS copy is removed so replacing a payload never leaves an orphan file.
+        ids = [_id for _id, _ in items]
+        in_gridfs = {doc["_id"] for doc in collection.find({"_id": {"$in": ids}, "gridfs": True}, {"_id": 1})}
+
+    writes = []
+    for _id, value in items:
+        data = serializer.dumps(value)
+        if _id in in_gridfs:
+            payload_fs.delete(_id)
+        if len(data) > PAYLOAD_GRIDFS_BYTES:
+            payload_fs.put(data, _id=_id)
+            doc = {"gridfs": True, "size": len(data)}
+        else:
+            doc = {"data": Binary(data), "size": len(data)}
+        writes.append(ReplaceOne({"_id": _id}, doc, upsert=True))
+    collection.bulk_write(writes, ordered=False)
+
+
+def load_payload(collection, _id):
+    doc = collection.find_one({"_id": _id})
+    if not doc:
+        return None
+    data = payload_fs.get(_id).read() if doc.get("gridfs") else doc["data"]
+    return serializer.loads(data)
+
+
 def insert_email(data: dict):
+    # The body goes to email_bodies, email_table only keeps its size.
     doc = data.copy()
+    doc["_id"] = ObjectId()
+    body = doc.pop("body", None)
+    if body is not None:
+        save_payloads(email_bodies, [(doc["_id"], body)], replace=False)
+        doc["body_size"] = len(body)
     return email_table.insert_one(doc).inserted_id
 
 
+def get_email_body(email_table_id):
+    return load_payload(email_bodies, ObjectId(email_table_id))
+
+
 def insert_file(data: dict):
     doc = data.copy()
     return file_table.insert_one(doc).inserted_id
 
 
-def update_ocr_response(file_table_id, ocr_response):
-    file_table.update_one(
-        {"_id": ObjectId(file_table_id)}, {"$set": {"ocr_response": ocr_response}}
+def insert_files(data: list) -> list:
+    # All rows in one round trip, the ids come back in the same order.
+    docs = [row.copy() for row in data]
+    if not docs:
+        return []
+    return file_table.insert_many(docs, ordered=False).inserted_ids
+
+
+def ocr_fields(ocr_response, ocr_sources=None) -> dict:
+    # What stays on the file row, the text itself is in ocr_results.
+    fields = {"ocr_pages": len(ocr_response), "ocr_at": datetime.utcnow()}
+    if ocr_sources is not None:
+        # Which pages were read from the pdf text layer and which went through Textract.
+        fields["ocr_sources"] = ocr_sources
+    return fields
+
+
+def update_ocr_response(file_table_id, ocr_response, ocr_sources=None):
+    update_ocr_responses([(file_table_id, ocr_response, ocr_sources)])
+
+
+def update_ocr_responses(results: list):
+    # Bulk version of update_ocr_response for (file_table_id, ocr_response, ocr_sources) items.
+    save_payloads(
+        ocr_results,
+        [(ObjectId(file_table_id), ocr_response) for file_table_id, ocr_response, _ in results],
     )
 
+    updates = [
+        UpdateOne({"_id": ObjectId(file_table_id)}, {"$set": ocr_fields(ocr_response, ocr_sources)})
+        for file_table_id, ocr_response, ocr_sources in results
+    ]
+    if updates:
+        file_table.bulk_write(updates, ordered=False)
+
+
+def get_ocr_response(file_table_id):
+    return load_payload(ocr_results, ObjectId(file_table_id))
+
 
 def insert_bills(data: list):
     docs = data.copy()
@@ -42,3 +163,124 @@ def insert_bills(data: list):
 def insert_invoice(data: list):
     docs = data.copy()
     invoice_table.insert_many(docs)
+
+
+def existing_microsoft_ids(microsoft_ids: list) -> set:
+    cursor = email_table.find(
+        {"microsoft_id": {"$in": microsoft_ids}}, {"microsoft_id": 1, "_id": 0}
+    )
+    return {doc["microsoft_id"] for doc in cursor}
+
+
+def get_delta_link(mailbox: str):
+    state = sync_state.find_one({"_id": mailbox})
+    return state["delta_link"] if state else None
+
+
+def save_delta_link(mailbox: str, delta_link: str):
+    sync_state.update_one(
+        {"_id": mailbox},
+        {"$set": {"delta_link": delta_link, "updated_at": datetime.utcnow()}},
+        upsert=True,
+    )
+
+
+def claim_keys(keys: list) -> set:
+    # One round trip for the whole list. Keys that already exist fail with a duplicate key error (11000).
+    docs = [{"_id": key, "created_at": datetime.utcnow()} for key in keys]
+    try:
+        processed_keys.insert_many(docs, ordered=False)
+        return set(keys)
+    except BulkWriteError as error:
+        duplicates = {
+            keys[e["index"]] for e in error.details["writeErrors"] if e["code"] == 11000
+        }
+        return set(keys) - duplicates
+
+
+def release_keys(keys: list):
+    # Undoes claim_keys for work that failed, so a later webhook or sync can claim the keys again.
+    if keys:
+        processed_keys.delete_many({"_id": {"$in": list(keys)}})
+
+
+def claim_contents(entries: list) -> dict:
+    # Registers the first file_table row for each content hash, for (content_hash, file_table_id, s3_key) items.
+    # Returns {position: original entry} for the items whose hash was already known, including repeats within entries.
+    docs = [
+        {"_id": content_hash, "file_table_id": file_table_id, "s3_key": s3_key, "created_at": datetime.utcnow()}
+        for content_hash, file_table_id, s3_key in entries
+    ]
+    if not docs:
+        return {}
+    try:
+        content_index.insert_many(docs, ordered=False)
+        return {}
+    except BulkWriteError as error:
+        positions = [e["index"] for e in error.details["writeErrors"] if e["code"] == 11000]
+        if len(positions) < len(error.details["writeErrors"]):
+            raise
+
+    hashes = [entries[position][0] for position in positions]
+    cursor = content_index.find({"_id": {"$in": hashes}}, {"file_table_id": 1, "s3_key": 1})
+    originals = {doc["_id"]: doc for doc in cursor}
+    return {position: originals[entries[position][0]] for position in positions}
+
+
+def link_duplicate_files(duplicates: list):
+    # The duplicate row points to the original's S3 object and results instead of having its own.
+    updates = [
+        UpdateOne(
+            {"_id": ObjectId(file_table_id)},
+            {
+                "$set": {
+                    "duplicate_of": original["file_table_id"],
+                    "s3_key": original["s3_key"],
+                }
+            },
+        )
+        for file_table_id, original in duplicates
+    ]
+    if updates:
+        file_table.bulk_write(updates, ordered=False)
+
+
+def mark_file_failed(file_table_id, status):
+    # * The failed row gives up its content_index claim, so the next copy of these bytes is processed again
+    # * instead of being linked to a row that has no results. Copies already linked to it get the same status.
+    _id = ObjectId(file_table_id)
+    row = file_table.find_one_and_update(
+        {"_id": _id}, {"$set": {"status": int(status)}}, {"content_hash": 1}
+    )
+    if row and row.get("content_hash"):
+        content_index.delete_one({"_id": row["content_hash"], "file_table_id": _id})
+    file_table.update_many({"duplicate_of": _id}, {"$set": {"status": int(status)}})
+
+
+def ensure_indexes():
+    # create_indexes skips indexes that already exist, so this is cheap to run on every start.
+    for name, indexes in INDEXES.items():
+        try:
+            db[name].create_indexes(indexes)
+        except OperationFailure as e:
+            print(f"Error while creating indexes on {name}:", e)
+
+
+def get_cached_extraction(key: str):
+    doc = extraction_cache.find_one({"_id": key}, {"invoices": 1, "elapsed": 1})
+    if doc:
+        return {"invoices": doc["invoices"], "elapsed": doc.get("elapsed", 0.0)}
+    return None
+
+
+def save_cached_extraction(key: str, invoices: list, elapsed: float):
+    extraction_cache.update_one(
+        {"_id": key},
+        {"$set": {"invoices": invoices, "elapsed": elapsed, "created_at": datetime.utcnow()}},
+        upsert=True,
+    )
+
+    overflow = extraction_cache.estimated_document_count() - EXTRACTION_CACHE_MAX_DOCS
+    if overflow > 0:
+        oldest = extraction_cache.find({}, {"_id": 1}).sort("created_at", 1).limit(overflow)
+        extraction_cache.delete_many({"_id": {"$in": [doc["_id"] for doc in oldest]}})
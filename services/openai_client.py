@@ -0,0 +1,88 @@
+from dotenv import load_dotenv
+import requests
+import os, re, time, random, threading
+
+from utils.http import new_session, CallStats
+
+load_dotenv()
+api_key = os.getenv("OPENAI_KEY")
+
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+OPENAI_TIMEOUT = (5, float(os.getenv("OPENAI_READ_TIMEOUT", 120)))  # (connect, read) in seconds
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", 5))
+MAX_BACKOFF = 60
+RETRYABLE_STATUS = (408, 409, 429, 500, 502, 503, 504)
+
+session = new_session(pool_maxsize=int(os.getenv("OPENAI_POOL_SIZE", 10)))
+stats = CallStats()
+counters_lock = threading.Lock()
+counters = {"requests": 0, "attempts": 0, "retries": 0, "failures": 0}
+
+# Matches the parts of durations like "1s", "6m0s", "20ms" or "1h2m3.5s" used in x-ratelimit-reset-* headers.
+DURATION_PART = re.compile(r"([\d.]+)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> float:
+    return sum(float(n) * DURATION_UNITS[unit] for n, unit in DURATION_PART.findall(value or ""))
+
+
+def retry_delay(response, attempt: int) -> float:
+    # * The server's own hints win: retry-after(-ms), then the reset time of whichever rate limit is exhausted.
+    if response is not None:
+        headers = response.headers
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after", "").replace(".", "", 1).isdigit():
+            return float(headers["retry-after"])
+        if headers.get("x-ratelimit-remaining-requests") == "0":
+            return parse_duration(headers.get("x-ratelimit-reset-requests"))
+        if headers.get("x-ratelimit-remaining-tokens") == "0":
+            return parse_duration(headers.get("x-ratelimit-reset-tokens"))
+    # Exponential backoff with jitter when there is no hint.
+    return min(2**attempt, MAX_BACKOFF) * random.uniform(0.5, 1)
+
+
+def count(**values):
+    with counters_lock:
+        for key, value in values.items():
+            counters[key] += value
+
+
+def chat_completion(payload: dict):
+    # Returns the last response (successful or not), or None when every attempt failed to connect.
+    count(requests=1)
+    for attempt in range(OPENAI_RETRIES + 1):
+        response = None
+        count(attempts=1)
+        try:
+            with stats.timer("chat_completion"):
+                response = session.post(
+                    OPENAI_URL,
+                    headers={
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {api_key}",
+                    },
+                    json=payload,
+                    timeout=OPENAI_TIMEOUT,
+                )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print("OpenAI request failed:", e)
+
+        if response is not None and response.status_code not in RETRYABLE_STATUS:
+            return response
+
+        if attempt == OPENAI_RETRIES:
+            break
+        count(retries=1)
+        time.sleep(min(retry_delay(response, attempt), MAX_BACKOFF))
+
+    count(failures=1)
+    return response
+
+
+def metrics() -> dict:
+    with counters_lock:
+        result = dict(counters)
+    result["latency"] = stats.snapshot()
+    return result
@@ -0,0 +1,10 @@
+import os, sys
+
+# The services read their settings from the environment on import.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("mail", "bills@example.com")
+os.environ.setdefault("data_path", "bill_test")
+os.environ.setdefault("boto3_region_name", "us-east-1")
+os.environ.setdefault("boto3_aws_access_key_id", "testing")
+os.environ.setdefault("boto3_aws_secret_access_key", "testing")
+os.environ.setdefault("S3_BUCKET_NAME", "test-bills")
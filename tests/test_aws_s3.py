@@ -0,0 +1,85 @@
+import hashlib
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from services import aws
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    # moto stands in for S3, the module client is swapped for one created inside the mock.
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=aws.S3_BUCKET_NAME)
+        monkeypatch.setattr(aws, "s3client", client)
+        yield client
+
+
+def test_content_key():
+    digest = hashlib.sha256(b"invoice").hexdigest()
+    assert aws.content_key("data/sub/client/corp", digest) == f"data/sub/client/corp/{digest}.pdf"
+    assert aws.content_key("blobs", digest, "") == f"blobs/{digest}"
+
+
+def test_object_exists(bucket):
+    assert not aws.object_exists("missing.pdf")
+    bucket.put_object(Bucket=aws.S3_BUCKET_NAME, Key="present.pdf", Body=b"x")
+    assert aws.object_exists("present.pdf")
+
+
+def test_upload_to_s3_skip_existing(bucket):
+    assert aws.upload_to_s3(b"%PDF-1.4 first", "a.pdf", skip_existing=True)
+    assert not aws.upload_to_s3(b"%PDF-1.4 second", "a.pdf", skip_existing=True)
+
+    res = bucket.get_object(Bucket=aws.S3_BUCKET_NAME, Key="a.pdf")
+    assert res["Body"].read() == b"%PDF-1.4 first"
+    assert res["ContentType"] == "application/pdf"
+
+
+def test_upload_to_s3_multipart(bucket, monkeypatch):
+    monkeypatch.setattr(aws.transfer_config, "multipart_threshold", 5 * aws.MB)
+    monkeypatch.setattr(aws.transfer_config, "multipart_chunksize", 5 * aws.MB)
+    content = b"x" * (11 * aws.MB)
+
+    assert aws.upload_to_s3(content, "large.pdf")
+
+    res = bucket.head_object(Bucket=aws.S3_BUCKET_NAME, Key="large.pdf")
+    assert res["ContentLength"] == len(content)
+    # Multipart uploads get an ETag ending in the number of parts.
+    assert res["ETag"].strip('"').endswith("-3")
+
+
+def test_upload_many(bucket):
+    files = [(f"%PDF-1.4 {i}".encode(), f"many/{i}.pdf") for i in range(10)]
+    bucket.put_object(Bucket=aws.S3_BUCKET_NAME, Key="many/0.pdf", Body=b"already there")
+
+    assert aws.upload_many(files) == [None] * 10
+    assert aws.download_from_s3("many/0.pdf") == b"already there"
+    assert aws.download_from_s3("many/9.pdf") == b"%PDF-1.4 9"
+
+
+def test_upload_many_reports_errors(bucket, monkeypatch):
+    monkeypatch.setattr(aws, "S3_BUCKET_NAME", "no-such-bucket")
+    errors = aws.upload_many([(b"x", "a.pdf"), (b"y", "b.pdf")])
+    assert all(isinstance(e, Exception) for e in errors)
+    assert aws.upload_many([]) == []
+
+
+def test_upload_many_copies_from_source_key(bucket, monkeypatch):
+    aws.upload_blob(b"%PDF-1.4 blob", "blobs/abc")
+    uploads = []
+    monkeypatch.setattr(aws, "upload_to_s3", lambda **kwargs: uploads.append(kwargs["key"]))
+
+    assert aws.upload_many([(b"%PDF-1.4 blob", "copied.pdf", "blobs/abc")]) == [None]
+
+    res = bucket.get_object(Bucket=aws.S3_BUCKET_NAME, Key="copied.pdf")
+    assert res["Body"].read() == b"%PDF-1.4 blob"
+    assert res["ContentType"] == "application/pdf"
+    assert uploads == []
+
+
+def test_upload_many_uploads_when_source_is_gone(bucket):
+    assert aws.upload_many([(b"%PDF-1.4 bytes", "fallback.pdf", "blobs/expired")]) == [None]
+    assert aws.download_from_s3("fallback.pdf") == b"%PDF-1.4 bytes"
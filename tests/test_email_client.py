@@ -0,0 +1,67 @@
+import pytest
+
+import EmailClient as email_client_module
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, payload: dict = None, headers: dict = None):
+        self.status_code = status_code
+        self.payload = payload or {}
+        self.headers = headers or {}
+        self.text = str(payload)
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # No token or network, request() is replaced per test.
+    monkeypatch.setattr(email_client_module, "ConfidentialClientApplication", lambda **kwargs: None)
+    monkeypatch.setattr(email_client_module.time, "sleep", lambda seconds: None)
+    return email_client_module.EmailClient()
+
+
+def test_batch_retries_throttled_items_and_keeps_order(client, monkeypatch):
+    sent = []
+
+    def request(name, method, url, **kwargs):
+        ids = [r["id"] for r in kwargs["json"]["requests"]]
+        sent.append(ids)
+        responses = []
+        # Graph answers in any order, the first attempt throttles request "1".
+        for request_id in reversed(ids):
+            if request_id == "1" and len(sent) == 1:
+                responses.append({"id": request_id, "status": 429, "headers": {"Retry-After": "1"}})
+            else:
+                responses.append({"id": request_id, "status": 200, "body": f"body {request_id}"})
+        return FakeResponse(200, {"responses": responses})
+
+    monkeypatch.setattr(client, "request", request)
+    responses = client.batch([{"method": "GET", "url": f"/messages/{i}"} for i in range(3)])
+
+    assert sent == [["0", "1", "2"], ["1"]]
+    assert [res["body"] for res in responses] == ["body 0", "body 1", "body 2"]
+
+
+def test_batch_splits_into_chunks_and_fills_missing_responses(client, monkeypatch):
+    def request(name, method, url, **kwargs):
+        # Request "5" never gets an answer.
+        responses = [
+            {"id": r["id"], "status": 200, "body": r["id"]} for r in kwargs["json"]["requests"] if r["id"] != "5"
+        ]
+        return FakeResponse(200, {"responses": responses})
+
+    monkeypatch.setattr(client, "request", request)
+    responses = client.batch([{"method": "GET", "url": f"/messages/{i}"} for i in range(25)])
+
+    assert len(responses) == 25
+    assert responses[5]["status"] == 0
+    assert [res["body"] for i, res in enumerate(responses) if i != 5] == [str(i) for i in range(25) if i != 5]
+
+
+def test_retry_after_seconds():
+    assert email_client_module.retry_after_seconds("3", 1) == 3
+    assert email_client_module.retry_after_seconds(None, 2) == 2
+    assert email_client_module.retry_after_seconds("soon", 2) == 2
+    assert email_client_module.retry_after_seconds("3600", 1) == email_client_module.MAX_RETRY_AFTER
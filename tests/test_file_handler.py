@@ -0,0 +1,51 @@
+import io, zipfile, hashlib
+from datetime import datetime
+
+import FileHandler as file_handler
+
+PDF = b"%PDF-1.4\n" + b"x" * 500
+
+
+def make_zip(files: list) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_nested_archives_share_one_budget(monkeypatch):
+    monkeypatch.setattr(file_handler, "ARCHIVE_MAX_TOTAL_BYTES", 3000)
+    monkeypatch.setattr(file_handler, "FILE_PROCESSES", 0)
+    inner = [make_zip([(f"bill{i}.pdf", PDF)]) for i in range(8)]
+    outer = make_zip([(f"inner{i}.zip", data) for i, data in enumerate(inner)])
+
+    handler = file_handler.FileHandler(datetime(2024, 1, 15))
+    pdf_files = handler.collectPdfFiles([{"filename": "outer.zip", "content_bytes": outer}])
+
+    assert handler.archive_bytes <= 3000
+    assert len(pdf_files) < len(inner)
+
+
+def test_broken_member_keeps_the_rest():
+    good = make_zip([("good.pdf", PDF)])
+    handler = file_handler.FileHandler(datetime(2024, 1, 15))
+    pdf_files = handler.collectPdfFiles(
+        [{"filename": "bills.zip", "content_bytes": good}, {"filename": "bad.zip", "content_bytes": b"PK\x03\x04broken"}]
+    )
+    assert [p.source_filename for p in pdf_files] == ["good.pdf"]
+
+
+def test_converted_files_are_hashed_by_their_source(monkeypatch):
+    from PIL import Image
+
+    monkeypatch.setattr(file_handler, "FILE_PROCESSES", 0)
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 400), "white").save(buffer, format="jpeg")
+    photo = buffer.getvalue()
+
+    first, second = (
+        file_handler.FileHandler(datetime(2024, 1, day)).collectPdfFiles([{"filename": "bill.jpg", "content_bytes": photo}])[0]
+        for day in (15, 16)
+    )
+    assert first.content_hash == second.content_hash == hashlib.sha256(photo).hexdigest()
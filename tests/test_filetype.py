@@ -0,0 +1,65 @@
+import io, zipfile
+
+import pytest
+
+from utils import filetype
+
+
+def make_zip(names: list) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for name in names:
+            archive.writestr(name, b"%PDF-1.4 stored member" if name.endswith(".pdf") else b"<xml/>")
+    return buffer.getvalue()
+
+
+EMAIL = b"Received: from mx\r\nFrom: a@example.com\r\nSubject: bill\r\n\r\nsee %PDF-1.4 attached\r\n"
+
+
+@pytest.mark.parametrize(
+    "data, filename, expected",
+    [
+        (b"%PDF-1.7\n...", "bill.jpg", (filetype.PDF, ".pdf")),
+        (b"\xff\xd8\xff\xe0JFIF", "bill.pdf", (filetype.IMAGE, ".jpg")),
+        (b"II*\x00rest", "", (filetype.IMAGE, ".tif")),
+        (b"\r\n\r\n%PDF-1.4\n...", "bill", (filetype.PDF, ".pdf")),
+        # The signatures are checked before the loose "%PDF-" search.
+        (make_zip(["bill.pdf"]), "bills.zip", (filetype.ZIP, ".zip")),
+        (EMAIL, "forwarded", (filetype.EML, ".eml")),
+        (b"Rar!\x1a\x07\x01\x00", "a.zip", (filetype.RAR, ".rar")),
+        (b"7z\xbc\xaf\x27\x1c\x00\x04", "a.rar", (filetype.SEVEN_ZIP, ".7z")),
+        (filetype.OLE_MAGIC + b"\x00" * 8, "sheet.xls", (filetype.OFFICE, ".xls")),
+        (filetype.OLE_MAGIC + b"\x00" * 8, "mail.msg", (None, ".msg")),
+    ],
+)
+def test_signature_order(data, filename, expected):
+    assert filetype.sniff(data, filename) == expected
+
+
+def test_ooxml_and_plain_zip():
+    docx = make_zip(["[Content_Types].xml", "word/document.xml"])
+    xlsx = make_zip(["[Content_Types].xml", "xl/workbook.xml"])
+    plain = make_zip(["[Content_Types].xml", "readme.txt"])
+
+    assert filetype.sniff(docx, "invoice.zip") == (filetype.OFFICE, ".docx")
+    assert filetype.sniff(xlsx, "") == (filetype.OFFICE, ".xlsx")
+    assert filetype.sniff(plain, "invoice.docx") == (filetype.ZIP, ".zip")
+    assert filetype.sniff(b"PK\x03\x04broken", "a.zip") == (None, ".zip")
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        "Rechnung Nr. 1, Betrag 12,50 €\n".encode("utf-16"),
+        "Invoice,Amount\n1,12.50\n".encode("utf-16-le"),
+        "Facture n°1;Montant 12,50\n".encode("latin-1"),
+        "Invoice,Amount\n1,12.50\n".encode("utf-8"),
+    ],
+)
+def test_text_in_any_encoding(data):
+    assert filetype.sniff(data, "bill.csv") == (filetype.OFFICE, ".csv")
+
+
+def test_binary_text_file_is_refused():
+    assert filetype.sniff(bytes(range(256)) * 4, "bill.txt") == (None, ".txt")
+    assert filetype.sniff(b"plain words", "notes", "text/plain") == (filetype.OFFICE, ".txt")
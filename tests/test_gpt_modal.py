@@ -0,0 +1,90 @@
+import pytest
+
+from extraction import gpt_modal
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    # The Mongo cache is replaced by a dict, the in process LRU starts empty.
+    store = {}
+    monkeypatch.setattr(gpt_modal, "cache_lru", gpt_modal.LRUCache(8))
+    monkeypatch.setattr(gpt_modal.db, "get_cached_extraction", store.get)
+    monkeypatch.setattr(
+        gpt_modal.db,
+        "save_cached_extraction",
+        lambda key, invoices, elapsed: store.__setitem__(key, {"invoices": invoices, "elapsed": elapsed}),
+    )
+    return store
+
+
+def long_document(pages=4):
+    return [{"page_number": n, "page_text": "x" * 20000} for n in range(1, pages + 1)]
+
+
+def test_failed_window_fails_the_document(monkeypatch, saved):
+    def request(window, property_name=None):
+        if window[0]["page_number"] == 1:
+            return None
+        return [{"invoice_number": f"A{window[0]['page_number']}"}]
+
+    monkeypatch.setattr(gpt_modal, "request_entities", request)
+
+    assert gpt_modal.extract_entities(long_document()) is None
+    assert saved == {}
+
+
+def test_complete_result_is_cached(monkeypatch, saved):
+    monkeypatch.setattr(
+        gpt_modal,
+        "request_entities",
+        lambda window, property_name=None: [{"invoice_number": f"A{window[0]['page_number']}"}],
+    )
+
+    invoices = gpt_modal.extract_entities(long_document())
+    assert [invoice["invoice_number"] for invoice in invoices] == ["A1", "A2", "A3", "A4"]
+    assert len(saved) == 1
+
+
+def test_chunk_pages_splits_oversized_pages_and_overlaps():
+    pages = [
+        {"page_number": 1, "page_text": "a" * 100},
+        {"page_number": 2, "page_text": "b" * 1000},
+        {"page_number": 3, "page_text": "c" * 100},
+    ]
+    windows = gpt_modal.chunk_pages(pages, budget=100)
+
+    # Page 2 is cut into parts under the budget, each part keeps its page number.
+    pages_in_order = list(windows[0])
+    for window in windows[1:]:
+        # A window starts on the last page of the previous one when both fit the budget.
+        pages_in_order += window[1:] if window[0] is pages_in_order[-1] else window
+    assert "".join(page["page_text"] for page in pages_in_order if page["page_number"] == 2) == "b" * 1000
+    for window in windows:
+        assert sum(gpt_modal.estimate_tokens(gpt_modal.compact(page)) for page in window) <= 100
+    assert [page["page_number"] for page in pages_in_order] == [1, 2, 2, 2, 3]
+
+
+def test_chunk_pages_overlaps_windows():
+    pages = [{"page_number": n, "page_text": "x" * 100} for n in range(1, 6)]
+    windows = gpt_modal.chunk_pages(pages, budget=80)
+
+    assert [[page["page_number"] for page in window] for window in windows] == [[1, 2], [2, 3], [3, 4], [4, 5]]
+
+
+def test_merge_invoices_by_invoice_number():
+    merged = gpt_modal.merge_invoices(
+        [
+            [{"invoice_number": "A1", "invoice_amount": "", "page_numbers": [1, 2], "line_items": [{"d": 1}]}],
+            [
+                {"invoice_number": "A1", "invoice_amount": "10.00", "page_numbers": [2, 3], "line_items": [{"d": 1}, {"d": 2}]},
+                {"invoice_number": "", "page_numbers": [3]},
+                {"invoice_number": "B2", "page_numbers": [4]},
+            ],
+            None,
+        ]
+    )
+
+    assert [invoice["invoice_number"] for invoice in merged] == ["A1", "", "B2"]
+    assert merged[0]["invoice_amount"] == "10.00"
+    assert merged[0]["page_numbers"] == [1, 2, 3]
+    assert merged[0]["line_items"] == [{"d": 1}, {"d": 2}]
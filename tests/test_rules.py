@@ -0,0 +1,42 @@
+import pytest
+
+from extraction.gpt_modal import rule_extractor
+
+HEADER = "Vendor: Acme Supply Co. Invoice No: 12345 Invoice Date: 01/15/2024 "
+
+
+def extract(text):
+    return rule_extractor.extract([{"page_number": 1, "page_text": text}])
+
+
+def test_single_total_is_trusted():
+    result = extract(HEADER + "Total Due $350.00")
+    assert result["invoice"]["invoice_amount"] == "350.00"
+    assert result["invoice"]["vendor_name"] == "Acme Supply Co."
+    assert result["confidence"] == 1.0
+
+
+@pytest.mark.parametrize(
+    "amounts, expected",
+    [
+        ("Previous Balance $200.00 Total Due $350.00", "350.00"),
+        ("Net Amount 1,200.00 Tax 25.00 Total 1,225.00", "1,225.00"),
+        ("Sub Total $300.00 Total Amount Due $350.00", "350.00"),
+    ],
+)
+def test_total_due_wins_and_disagreeing_amounts_lower_confidence(amounts, expected):
+    result = extract(HEADER + amounts)
+    assert result["invoice"]["invoice_amount"] == expected
+    assert result["confidence"] < 1.0
+
+
+def test_same_amount_twice_is_not_a_disagreement():
+    result = extract(HEADER + "Amount Due $350.00 Total Due $ 350.00")
+    assert result["invoice"]["invoice_amount"] == "350.00"
+    assert result["confidence"] == 1.0
+
+
+def test_account_number_is_not_the_invoice_number():
+    result = extract("Vendor: Acme Supply Co. Account Number: 998877 Invoice Date: 01/15/2024 Total Due $350.00")
+    assert result["invoice"]["invoice_number"] == ""
+    assert result["confidence"] < 1.0
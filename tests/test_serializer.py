@@ -0,0 +1,24 @@
+from datetime import datetime, date
+
+from utils import serializer
+
+
+def test_round_trip_keeps_types():
+    doc = {
+        "receivedDateTime": datetime(2024, 1, 15, 9, 30, 5),
+        "due": date(2024, 2, 1),
+        "content_bytes": b"%PDF-1.4\x00\xff",
+        "attachments": [{"filename": "bill.pdf", "blob_ref": "s3:blobs/abc"}],
+        "microsoft_id": None,
+    }
+    assert serializer.loads(serializer.dumps(doc)) == doc
+
+
+def test_large_messages_are_compressed():
+    small = serializer.dumps({"body": "x"})
+    large = serializer.dumps({"body": "x" * 10000})
+
+    assert small[:1] == serializer.RAW
+    assert large[:1] == serializer.ZSTD
+    assert len(large) < 1000
+    assert serializer.loads(large) == {"body": "x" * 10000}
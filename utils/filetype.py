@@ -0,0 +1,106 @@
+import re, io, os, zipfile
+
+# * Content based routing for FileHandler: the kind of a file comes from its leading bytes first,
+# * then from Graph's contentType and the extension, so misnamed or extension-less files take the right path.
+PDF = "pdf"
+IMAGE = "image"
+OFFICE = "office"
+ZIP = "zip"
+RAR = "rar"
+SEVEN_ZIP = "7z"
+EML = "eml"
+
+IMAGE_MAGIC = [
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"BM", ".bmp"),
+    (b"II*\x00", ".tif"),
+    (b"MM\x00*", ".tif"),
+]
+OLE_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+RAR_MAGIC = b"Rar!\x1a\x07"
+SEVEN_ZIP_MAGIC = b"7z\xbc\xaf\x27\x1c"
+ZIP_MAGIC = (b"PK\x03\x04", b"PK\x05\x06")
+OOXML_FOLDERS = {"word/": ".docx", "xl/": ".xlsx", "ppt/": ".pptx"}
+TEXT_EXTENSIONS = [".txt", ".csv"]
+OLE_EXTENSIONS = [".doc", ".xls", ".ppt"]
+
+# A message starts with header lines like "Received: ..." or "MIME-Version: 1.0".
+HEADER_LINE = re.compile(
+    rb"^(Received|Return-Path|From|To|Cc|Subject|Date|Message-ID|MIME-Version|Content-Type|"
+    rb"Delivered-To|Reply-To|Thread-Topic|Thread-Index|DKIM-Signature|Authentication-Results|X-[\w-]+):",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def looks_like_email(data: bytes) -> bool:
+    return len(HEADER_LINE.findall(data[:4096])) >= 2
+
+
+UTF16_BOMS = (b"\xff\xfe", b"\xfe\xff")
+# Control characters that do not show up in text files (tab, new lines, form feed and escape do).
+CONTROL_BYTES = bytes(set(range(32)) - {9, 10, 12, 13, 27})
+
+
+def looks_binary(data: bytes) -> bool:
+    # Any encoding is accepted (latin-1, cp1252, utf-16 exports), only clearly binary content is refused.
+    sample = data[:4096]
+    if not sample or sample.startswith(UTF16_BOMS):
+        return False
+    if b"\x00" in sample:
+        # UTF-16 without a BOM: ascii characters leave a NUL in every other byte.
+        nulls = max(sample[0::2].count(0), sample[1::2].count(0))
+        return nulls < len(sample) // 2 * 0.4
+    controls = len(sample) - len(sample.translate(None, CONTROL_BYTES))
+    return controls > len(sample) * 0.1
+
+
+def sniff(data: bytes, filename: str = "", content_type: str = ""):
+    # Returns (kind, extension) or (None, extension) when the file can not be converted.
+    ext = os.path.splitext(filename or "")[1].lower()
+    content_type = (content_type or "").lower()
+    head = data[:16] if data else b""
+
+    if head.startswith(b"%PDF"):
+        return PDF, ".pdf"
+
+    for magic, image_ext in IMAGE_MAGIC:
+        if head.startswith(magic):
+            return IMAGE, image_ext
+
+    if head.startswith(ZIP_MAGIC):
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                names = archive.namelist()
+        except zipfile.BadZipFile:
+            return None, ext
+        if "[Content_Types].xml" in names:
+            for folder, office_ext in OOXML_FOLDERS.items():
+                if any(name.startswith(folder) for name in names):
+                    return OFFICE, office_ext
+        return ZIP, ".zip"
+
+    if head.startswith(OLE_MAGIC):
+        #! Outlook .msg files are OLE too, LibreOffice can not convert them.
+        if ext == ".msg" or "ms-outlook" in content_type:
+            return None, ext
+        return OFFICE, ext if ext in OLE_EXTENSIONS else ".doc"
+
+    if head.startswith(RAR_MAGIC):
+        return RAR, ".rar"
+
+    if head.startswith(SEVEN_ZIP_MAGIC):
+        return SEVEN_ZIP, ".7z"
+
+    # Some generators put a few bytes before the header, checked after the other signatures
+    # because a stored zip member or an email can contain "%PDF-" too.
+    if b"%PDF-" in data[:1024] and not looks_like_email(data):
+        return PDF, ".pdf"
+
+    if content_type == "message/rfc822" or ext == ".eml" or looks_like_email(data):
+        return EML, ".eml"
+
+    if (ext in TEXT_EXTENSIONS or content_type in ("text/plain", "text/csv")) and not looks_binary(data):
+        return OFFICE, ext if ext in TEXT_EXTENSIONS else ".txt"
+
+    return None, ext
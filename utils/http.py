@@ -0,0 +1,50 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+import time, threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+def new_session(pool_maxsize: int = 10) -> requests.Session:
+    # * One session per remote service keeps TCP/TLS connections alive between calls.
+    # * pool_block=True makes extra threads wait for a free connection instead of opening throwaway ones.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class CallStats:
+    # Thread safe counters for the latency of outgoing calls, grouped by a call name.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = defaultdict(lambda: {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+    def record(self, name: str, elapsed_ms: float):
+        with self.lock:
+            entry = self.calls[name]
+            entry["calls"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                name: {
+                    "calls": entry["calls"],
+                    "total_ms": round(entry["total_ms"], 2),
+                    "avg_ms": round(entry["total_ms"] / entry["calls"], 2),
+                    "max_ms": round(entry["max_ms"], 2),
+                }
+                for name, entry in self.calls.items()
+            }
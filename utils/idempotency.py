@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import threading
+
+from services import mongodb as db
+
+
+class LRUCache:
+    # Small thread safe LRU map, the oldest entry is dropped once maxsize is reached.
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def set(self, key, value=True):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+
+class IdempotencyStore:
+    # * Keys seen recently by this process are answered from memory.
+    # * Everything else is claimed in Mongo, where a unique _id makes the first claim win across processes.
+    def __init__(self, maxsize: int = 10000):
+        self.recent = LRUCache(maxsize)
+
+    def claim_many(self, keys: list) -> list:
+        # Returns the keys that were not seen before, in their original order.
+        unseen = list(dict.fromkeys(k for k in keys if k not in self.recent))
+        if not unseen:
+            return []
+
+        try:
+            new_keys = db.claim_keys(unseen)
+        except Exception as e:
+            #! If Mongo is down we prefer a possible duplicate over a lost mail.
+            print("Error while claiming keys in mongo:", e)
+            new_keys = set(unseen)
+
+        for key in unseen:
+            self.recent.set(key)
+        return [k for k in unseen if k in new_keys]
+
+    def release(self, keys: list):
+        # Called when the work for claimed keys failed, the next webhook or sync may claim them again.
+        for key in keys:
+            self.recent.pop(key)
+        try:
+            db.release_keys(keys)
+        except Exception as e:
+            print("Error while releasing keys in mongo:", e)
@@ -0,0 +1,79 @@
+from PIL import Image, ImageChops, ImageStat
+import io
+
+#! Textract synchronous operations accept images up to 10 MB and 10000 px on the longest side.
+TEXTRACT_MAX_BYTES = 10 * pow(10, 6)
+TEXTRACT_MAX_SIDE = 10000
+
+# Quality steps tried on a small sample, the highest one that fits the budget is used for the real encode.
+QUALITY_STEPS = (85, 75, 60, 45)
+SAMPLE_SIZE = 512
+# * Below this many bytes per sample value a q85 JPEG can not reach the limit, so no estimation is needed.
+SAFE_BYTES_PER_SAMPLE = 0.6
+
+
+def is_grayscale(image: Image.Image, tolerance: float = 6) -> bool:
+    # Scanned pages are often RGB with (almost) equal channels. Checked on a thumbnail so it stays cheap.
+    if image.mode in ("1", "L", "LA", "I", "F"):
+        return True
+    #! The page is shrunk before convert(), a full size RGB copy of a 300 DPI page takes tens of MB.
+    factor = max(1, max(image.size) // 256)
+    try:
+        small = image.reduce(factor)
+    except ValueError:
+        # reduce() does not support palette images.
+        small = image.resize((max(1, image.size[0] // factor), max(1, image.size[1] // factor)), Image.NEAREST)
+    thumb = small.convert("RGB")
+    thumb.thumbnail((128, 128))
+    r, g, b = thumb.split()
+    diff = ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b))
+    return ImageStat.Stat(diff).mean[0] <= tolerance
+
+
+def jpeg_bytes(image: Image.Image, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    # 4:2:0 chroma subsampling for colour pages, OCR does not need full resolution colour.
+    image.save(buffer, format="jpeg", quality=quality, subsampling=2)
+    return buffer.getvalue()
+
+
+def fit_quality(image: Image.Image, max_bytes: int):
+    # Estimates the encoded size from a centre crop and returns (quality, scale) for a single full encode.
+    width, height = image.size
+    samples = width * height * len(image.getbands())
+    if samples * SAFE_BYTES_PER_SAMPLE <= max_bytes:
+        return QUALITY_STEPS[0], 1.0
+
+    left = max(0, (width - SAMPLE_SIZE) // 2)
+    top = max(0, (height - SAMPLE_SIZE) // 2)
+    sample = image.crop((left, top, left + min(width, SAMPLE_SIZE), top + min(height, SAMPLE_SIZE)))
+    ratio = (width * height) / (sample.size[0] * sample.size[1])
+
+    estimate = 0
+    for quality in QUALITY_STEPS:
+        # 10% headroom because the crop is only an estimate of the whole page.
+        estimate = len(jpeg_bytes(sample, quality)) * ratio * 1.1
+        if estimate <= max_bytes:
+            return quality, 1.0
+
+    return QUALITY_STEPS[-1], min(1.0, (max_bytes / estimate) ** 0.5)
+
+
+def encode_for_textract(image: Image.Image, max_bytes: int = TEXTRACT_MAX_BYTES) -> bytes:
+    # * Picks resolution, colour mode and quality up front so the page is normally encoded only once.
+    if max(image.size) > TEXTRACT_MAX_SIDE:
+        image = image.copy()
+        image.thumbnail((TEXTRACT_MAX_SIDE, TEXTRACT_MAX_SIDE))
+
+    image = image.convert("L") if is_grayscale(image) else image.convert("RGB")
+
+    quality, scale = fit_quality(image, max_bytes)
+    while True:
+        if scale < 1.0:
+            size = (max(1, int(image.size[0] * scale)), max(1, int(image.size[1] * scale)))
+            image = image.resize(size, Image.LANCZOS)
+        img_data = jpeg_bytes(image, quality)
+        #! Only when the estimate was wrong, shrink a bit and encode again.
+        if len(img_data) <= max_bytes:
+            return img_data
+        scale = 0.8
@@ -0,0 +1,48 @@
+from kombu.serialization import register
+import msgpack, zstandard
+from datetime import datetime, date
+
+# * Celery serializer for tasks.py: msgpack keeps bytes and datetimes native (no base64 or string escaping as with json),
+# * and payloads above COMPRESS_THRESHOLD bytes are zstd compressed. The first byte of a message tells which one it is.
+SERIALIZER_NAME = "msgpack-zstd"
+CONTENT_TYPE = "application/x-msgpack-zstd"
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 3
+
+RAW, ZSTD = b"\x00", b"\x01"
+DATETIME_EXT, DATE_EXT = 1, 2
+
+
+def default(obj):
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(DATETIME_EXT, obj.isoformat().encode())
+    if isinstance(obj, date):
+        return msgpack.ExtType(DATE_EXT, obj.isoformat().encode())
+    raise TypeError(f"Can not serialize {type(obj)}")
+
+
+def ext_hook(code: int, data: bytes):
+    if code == DATETIME_EXT:
+        return datetime.fromisoformat(data.decode())
+    if code == DATE_EXT:
+        return date.fromisoformat(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj) -> bytes:
+    packed = msgpack.packb(obj, default=default, use_bin_type=True)
+    if len(packed) < COMPRESS_THRESHOLD:
+        return RAW + packed
+    # Compressor objects are not thread safe, a new one per message is cheap enough.
+    return ZSTD + zstandard.ZstdCompressor(level=COMPRESS_LEVEL).compress(packed)
+
+
+def loads(data: bytes):
+    data = bytes(data)
+    body = data[1:]
+    if data[:1] == ZSTD:
+        body = zstandard.ZstdDecompressor().decompress(body)
+    return msgpack.unpackb(body, ext_hook=ext_hook, raw=False, strict_map_key=False)
+
+
+register(SERIALIZER_NAME, dumps, loads, content_type=CONTENT_TYPE, content_encoding="binary")
@@ -22,3 +22,4 @@ class Bill_Process_Status(IntEnum):
     EXTRACTION_FAILED = -3
     OCR_FAILED = -6
     INVALID_FILE = -7
+    UPLOAD_FAILED = -8